@@ -0,0 +1,28 @@
+"""
+Async file I/O adapter.
+
+Uses ayafileio (io_uring on Linux, kernel-level async I/O elsewhere) when it is
+installed, and falls back to aiofiles' thread-pool backend otherwise.
+Both backends expose the same aiofiles-style API.
+"""
+try:
+    import ayafileio as _backend
+except ImportError:
+    import aiofiles as _backend
+
+# Block size for streaming file copies (1 MiB)
+BLOCK_SIZE = 1 << 20
+
+
+def open(path: str, mode: str = "rb"):
+    """
+    Open a file for async I/O with the best available backend.
+    
+    Args:
+        path: Path of the file to open.
+        mode: File mode, as for the built-in open().
+        
+    Returns:
+        An async context manager yielding the opened file.
+    """
+    return _backend.open(path, mode)
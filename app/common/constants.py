@@ -4,15 +4,16 @@ Global constants for the application.
 This module defines in-memory storage and user identification for development.
 In production, these should be replaced with proper database and authentication.
 """
-import uuid
+from contextvars import ContextVar
+
+from app.common.file_store import ProjectFileStore
+from app.common.settings import settings
 
 # In-memory file storage simulation
-# Structure: {user_uuid: [{'filename': str, 'content': bytes, 'mime_type': str}]}
+# Structure: {user_uuid: {filename: FileRecord}}
 # Production replacement: PostgreSQL + Redis cache + S3/GCS blob storage
-PROJECT_FILE_STORE: dict[str, list[dict]] = {}
+PROJECT_FILE_STORE = ProjectFileStore(maxsize=settings.max_active_users)
 
-# Simulated user identifier (single user for development)
+# Identifier of the user making the current request, set by UserIdMiddleware
 # Production replacement: JWT-based authentication with user sessions
-user_uuid: str = str(uuid.uuid4())
-
-
+current_user_uuid: ContextVar[str] = ContextVar('user_uuid')
@@ -0,0 +1,19 @@
+"""
+FastAPI dependencies for objects managed by the application lifespan.
+"""
+from fastapi import Request
+
+from services.documents_services import DocumentsService
+
+
+def get_documents_service(request: Request) -> DocumentsService:
+    """
+    Return the DocumentsService created at application startup.
+    
+    Args:
+        request: Incoming request, used to reach the application state.
+        
+    Returns:
+        DocumentsService: Shared service bound to the Gemini client.
+    """
+    return request.app.state.documents_service
@@ -0,0 +1,123 @@
+"""
+In-memory store of the files uploaded by each user.
+
+Development stand-in for blob storage plus a metadata database; it keeps the
+most recently active users only, so memory and temporary disk use stay bounded.
+"""
+import asyncio
+import collections
+import contextlib
+import os
+import weakref
+from collections.abc import Callable, Iterator
+from typing import NamedTuple
+
+from cachetools import LRUCache
+
+
+class FileRecord(NamedTuple):
+    """Metadata of an uploaded project file."""
+
+    filename: str
+    path: str | None  # Temporary copy of the upload; None once uploaded to Gemini
+    mime_type: str
+    size: int
+    digest: str  # blake2b hex digest of the file contents
+
+
+class ProjectFileStore(LRUCache[str, dict[str, FileRecord]]):
+    """
+    Per-user file store that keeps only the most recently active users.
+    
+    Evicting a user removes their temporary files in a worker thread and
+    notifies the registered eviction listeners, so per-user state kept
+    elsewhere is bounded by the same limit. Users marked in use, while their
+    files are being stored or uploaded, are kept in favour of idle users. If
+    every user is in use, the least recent one is evicted anyway, and their
+    files are removed once they are no longer in use.
+    """
+
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self._users_in_use: collections.Counter[str] = collections.Counter()
+        self._evicted_in_use: dict[str, list[dict[str, FileRecord]]] = {}
+        self._pending_removals: set[asyncio.Future] = set()
+        self._eviction_listeners: list[weakref.WeakMethod] = []
+
+    def add_eviction_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        Register a bound method called with the ID of every evicted user.
+        
+        Listeners are held weakly, so registering does not keep their owner
+        alive.
+        
+        Args:
+            listener: Bound method taking the evicted user ID.
+        """
+        self._eviction_listeners.append(weakref.WeakMethod(listener))
+
+    @contextlib.contextmanager
+    def in_use(self, user_uuid: str) -> Iterator[None]:
+        """Protect a user's temporary files from eviction while the block runs."""
+        self._users_in_use[user_uuid] += 1
+        try:
+            yield
+        finally:
+            self._users_in_use[user_uuid] -= 1
+            if not self._users_in_use[user_uuid]:
+                del self._users_in_use[user_uuid]
+                for project_files in self._evicted_in_use.pop(user_uuid, []):
+                    self._remove_files(project_files)
+                    # A user stored again since is still active
+                    if user_uuid not in self:
+                        self._notify_eviction(user_uuid)
+
+    def popitem(self) -> tuple[str, dict[str, FileRecord]]:
+        """Evict the least recently used user not in use, removing their temporary files."""
+        skipped = []
+        user_uuid, project_files = super().popitem()
+        while user_uuid in self._users_in_use and self:
+            skipped.append((user_uuid, project_files))
+            user_uuid, project_files = super().popitem()
+        # Put back users in use as most recently used; this frees no space,
+        # so it never evicts again
+        for skipped_user_uuid, skipped_files in skipped:
+            super().__setitem__(skipped_user_uuid, skipped_files)
+
+        if user_uuid in self._users_in_use:
+            self._evicted_in_use.setdefault(user_uuid, []).append(project_files)
+        else:
+            self._remove_files(project_files)
+            self._notify_eviction(user_uuid)
+        return user_uuid, project_files
+
+    def _notify_eviction(self, user_uuid: str) -> None:
+        """Call the live eviction listeners, dropping those whose owner is gone."""
+        live_listeners = []
+        for listener_ref in self._eviction_listeners:
+            listener = listener_ref()
+            if listener is not None:
+                live_listeners.append(listener_ref)
+                listener(user_uuid)
+        self._eviction_listeners = live_listeners
+
+    def _remove_files(self, project_files: dict[str, FileRecord]) -> None:
+        """Remove the temporary files of evicted records off the event loop."""
+        paths = [record.path for record in project_files.values() if record.path is not None]
+        if not paths:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            _remove_paths(paths)
+            return
+        removal = loop.run_in_executor(None, _remove_paths, paths)
+        self._pending_removals.add(removal)
+        removal.add_done_callback(self._pending_removals.discard)
+
+
+def _remove_paths(paths: list[str]) -> None:
+    """Remove files, ignoring those already gone."""
+    for path in paths:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
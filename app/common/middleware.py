@@ -0,0 +1,104 @@
+import uuid
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.common.constants import current_user_uuid
+
+USER_ID_HEADER = "X-User-Id"
+
+
+class UserIdMiddleware:
+    """
+    Resolve the user making each request and expose it as current_user_uuid.
+    
+    The user is taken from the X-User-Id request header, which must be a
+    UUID, or a new one is generated when the header is missing. A malformed
+    header is rejected with 400. The resolved id is echoed back in the
+    X-User-Id response header, so clients can reuse it on later requests.
+    Being a plain ASGI middleware, the context variable set here is visible
+    to the endpoint and its dependencies.
+    """
+
+    def __init__(self, app: ASGIApp):
+        """
+        Initialize the middleware.
+        
+        Args:
+            app: ASGI application to wrap.
+        """
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        user_id = _parse_user_id(Headers(scope=scope).get(USER_ID_HEADER))
+        if user_id is None:
+            response = JSONResponse({"detail": f"Invalid {USER_ID_HEADER} header"}, status_code=400)
+            await response(scope, receive, send)
+            return
+
+        async def send_with_user_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append(USER_ID_HEADER, user_id)
+            await send(message)
+
+        token = current_user_uuid.set(user_id)
+        try:
+            await self.app(scope, receive, send_with_user_id)
+        finally:
+            current_user_uuid.reset(token)
+
+
+def _parse_user_id(header: str | None) -> str | None:
+    """
+    Resolve the user ID from the X-User-Id header value.
+    
+    Args:
+        header: Header value, or None when the header is missing.
+        
+    Returns:
+        str | None: The canonical form of the UUID in the header, a new UUID
+        when the header is missing, or None when it is not a valid UUID.
+    """
+    if not header:
+        return str(uuid.uuid4())
+    try:
+        return str(uuid.UUID(header))
+    except ValueError:
+        return None
+
+
+class BodySizeLimitMiddleware:
+    """
+    Reject requests whose declared body size exceeds a limit.
+    
+    The Content-Length header is checked before any of the body is received,
+    so an oversized upload is refused without FastAPI parsing or spooling it.
+    Bodies without a Content-Length pass through; uploaded files are still
+    size-checked while they are stored.
+    """
+
+    def __init__(self, app: ASGIApp, max_body_size: int):
+        """
+        Initialize the middleware.
+        
+        Args:
+            app: ASGI application to wrap.
+            max_body_size: Largest accepted request body, in bytes.
+        """
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            content_length = Headers(scope=scope).get("content-length")
+            if content_length and content_length.isdigit() and int(content_length) > self.max_body_size:
+                response = JSONResponse({"detail": "Request body too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
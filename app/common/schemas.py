@@ -0,0 +1,28 @@
+"""
+Response models for the API endpoints.
+
+Declaring these as return types lets FastAPI serialize responses straight to
+JSON bytes with Pydantic, without an intermediate dict and json.dumps().
+"""
+from pydantic import BaseModel
+
+
+class BriefResponse(BaseModel):
+    """Response of the /brief endpoint."""
+
+    project_id: str
+    store_name: str
+    brief: str
+
+
+class SearchResult(BaseModel):
+    """Search result for a single document."""
+
+    filename: str
+    snippet: str
+
+
+class SearchResponse(BaseModel):
+    """Response of the /search endpoint."""
+
+    results: list[SearchResult]
@@ -2,13 +2,18 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
-    """Application settings loaded from environment variables."""
+    """
+    Application settings loaded from environment variables.
+
+    Loaded once at import and frozen, so values are read-only at runtime.
+    """
 
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
         case_sensitive=False,
         extra="ignore",
+        frozen=True,
     )
 
     # Gemini API Configuration
@@ -16,15 +21,35 @@ class Settings(BaseSettings):
 
     # File Upload Configuration
     max_file_size: int = 15 * 1024 * 1024  # 15 MB in bytes
-    allowed_extensions: list[str] = ["pdf", "docx", "txt", "doc", "md"]
-    allowed_mime_types: list[str] = [
+    max_request_size: int = 256 * 1024 * 1024  # Largest request body accepted, checked before it is read
+    allowed_extensions: frozenset[str] = frozenset({"pdf", "docx", "txt", "doc", "md"})
+    allowed_mime_types: frozenset[str] = frozenset({
         "application/pdf",
         "text/plain",
         "application/msword",
         "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         "text/markdown",
         "text/x-markdown",
-    ]
+    })
+
+    # Project File Store Configuration
+    max_active_users: int = 1024  # Users whose files are kept before the least recent are evicted
+
+    # Gemini Connection Pool Configuration
+    gemini_max_connections: int = 128  # Max open connections to the Gemini API
+    gemini_max_keepalive_connections: int = 64  # Max idle connections kept alive
+
+    # Gemini Concurrency Configuration
+    gemini_generate_concurrency: int = 32  # Max in-flight brief/search requests per service
+    gemini_upload_concurrency: int = 8  # Max in-flight file uploads per service
+
+    # Gemini Retry Configuration
+    gemini_retry_attempts: int = 5  # Attempts per Gemini call on rate limits or server errors
+    gemini_retry_max_wait: float = 8.0  # Max seconds to wait between attempts
+
+    # Response Cache Configuration
+    response_cache_size: int = 1024  # Max cached Gemini responses per service
+    response_cache_ttl: int = 3600  # Seconds a cached Gemini response stays valid
 
 
 # Global settings instance
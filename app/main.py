@@ -1,14 +1,60 @@
+from contextlib import asynccontextmanager
+
+import httpx
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from google.genai import Client, types
 
+from app.common.middleware import (
+    USER_ID_HEADER,
+    BodySizeLimitMiddleware,
+    UserIdMiddleware,
+)
+from app.common.settings import settings
 from app.router.documents_router import router as documents_router
+from services.documents_services import DocumentsService
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create the Gemini client on startup and close it on shutdown.
+    
+    All Gemini calls share one HTTP/2 connection pool, owned by the application
+    rather than created at import time. HTTP/2 multiplexes concurrent requests
+    over a single connection, saving a TCP/TLS handshake per request.
+    
+    Args:
+        app: FastAPI application whose state receives the shared objects.
+    """
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=settings.gemini_max_connections,
+            max_keepalive_connections=settings.gemini_max_keepalive_connections,
+        )
+    )
+    client = Client(
+        api_key=settings.gemini_api_key,
+        http_options=types.HttpOptions(httpx_async_client=http_client),
+    ).aio
+    app.state.documents_service = DocumentsService(client)
+
+    yield
+
+    await client.aclose()
+    await http_client.aclose()
+
 
 app = FastAPI(
     title="The Agile Monkeys Assessment API",
     description="Gemini API integration with FastAPI for document briefing generation",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# Runs inside CORS, so a rejected upload still carries the CORS headers
+app.add_middleware(BodySizeLimitMiddleware, max_body_size=settings.max_request_size)
 # No CORS policy, not the purpose of this assessment
 app.add_middleware(
     CORSMiddleware,
@@ -16,7 +62,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[USER_ID_HEADER],
 )
+app.add_middleware(UserIdMiddleware)
 
 app.include_router(
     documents_router,
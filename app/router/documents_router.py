@@ -1,9 +1,10 @@
-from fastapi import APIRouter, HTTPException, UploadFile
-from fastapi.responses import JSONResponse
-from google.genai import Client, types
+from typing import Annotated
 
-from app.common.constants import PROJECT_FILE_STORE, user_uuid
-from app.common.settings import settings
+from fastapi import APIRouter, Depends, HTTPException, UploadFile
+
+from app.common.constants import PROJECT_FILE_STORE, current_user_uuid
+from app.common.dependencies import get_documents_service
+from app.common.schemas import BriefResponse, SearchResponse
 from services.documents_services import DocumentsService
 
 router = APIRouter(
@@ -11,11 +12,13 @@ router = APIRouter(
     tags=["documents"],
 )
 
-client = Client(api_key=settings.gemini_api_key).aio
-documents_service = DocumentsService(client)
+DocumentsServiceDep = Annotated[DocumentsService, Depends(get_documents_service)]
 
 @router.post("/brief")
-async def generate_brief(files: list[UploadFile]):
+async def generate_brief(
+    files: list[UploadFile],
+    documents_service: DocumentsServiceDep,
+) -> BriefResponse:
     """
     Generate a concise brief summary of uploaded documents using Gemini AI.
     
@@ -28,60 +31,57 @@ async def generate_brief(files: list[UploadFile]):
     
     Args:
         files: List of files to upload and analyze. At least one file is required.
+        documents_service: Shared DocumentsService, injected by FastAPI.
     
     Returns:
-        JSONResponse: A JSON object containing:
+        BriefResponse: A JSON object containing:
             - project_id (str): Unique identifier for this project/user session
             - store_name (str): Gemini file search store identifier
             - brief (str): AI-generated summary of the uploaded documents
     
     Raises:
         HTTPException 400: No files uploaded or invalid file name
-        HTTPException 413: File size exceeds maximum allowed (15 MB)
+        HTTPException 413: File size exceeds maximum allowed (15 MB), or the
+            request body exceeds the configured request size limit
         HTTPException 415: Unsupported file type or MIME type
     """
+    user_uuid = current_user_uuid.get()
     await documents_service.validate_documents(files)
     store_name = await documents_service.upload_files_to_store()
-    file_names = [f["filename"] for f in PROJECT_FILE_STORE.get(user_uuid, [])]
-    prompt = f"Provide a concise brief for the following documents: {', '.join(file_names)}"
-
-    response = await client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt,
-        config=types.GenerateContentConfig(
-            tools=[
-                types.Tool(
-                    file_search=types.FileSearch(
-                        file_search_store_names=[store_name]
-                    )
-                )
-            ]
-        )
+    brief = await documents_service.generate_brief(
+        store_name, PROJECT_FILE_STORE.get(user_uuid, {})
     )
 
-    return JSONResponse(content={
-        "project_id": user_uuid,
-        "store_name": store_name,
-        "brief": response.text
-    })
+    return BriefResponse(
+        project_id=user_uuid,
+        store_name=store_name,
+        brief=brief
+    )
 
 @router.post("/search")
-async def search_store(query: str, project_id: str = user_uuid):
+async def search_store(
+    query: str,
+    documents_service: DocumentsServiceDep,
+    project_id: str | None = None,
+) -> SearchResponse:
     """
     Search across uploaded documents using natural language queries.
     
     This endpoint allows you to search through previously uploaded documents
     using Gemini AI's semantic search capabilities. It searches all documents
-    associated with a project ID and returns relevant snippets.
+    associated with a project ID, in that project's file search store, and
+    returns relevant snippets.
     
     Args:
         query: Natural language search query (e.g., "What are the key findings?").
                Cannot be empty.
-        project_id: Optional project identifier. Defaults to current user session.
+        documents_service: Shared DocumentsService, injected by FastAPI.
+        project_id: Optional project identifier. Defaults to the user of the
+                    request, given by the X-User-Id header.
                     Use the project_id returned from the /brief endpoint.
     
     Returns:
-        JSONResponse: A JSON object containing:
+        SearchResponse: A JSON object containing:
             - results (list): List of search results, each containing:
                 - filename (str): Name of the document
                 - snippet (str): Relevant excerpt or AI-generated answer
@@ -91,16 +91,19 @@ async def search_store(query: str, project_id: str = user_uuid):
         HTTPException 404: No files found for the given project_id
         HTTPException 500: Error during search operation
     """
+    if project_id is None:
+        project_id = current_user_uuid.get()
     if not query:
         raise HTTPException(status_code=400, detail="Query cannot be empty")
     if not project_id:
         raise HTTPException(status_code=400, detail="Project ID is required")
-    if not PROJECT_FILE_STORE.get(project_id):
+    store_name = documents_service.get_store_name(project_id)
+    if store_name is None or not PROJECT_FILE_STORE.get(project_id):
         raise HTTPException(status_code=404, detail="No files found for the given project ID")
 
     try:
         project_files = PROJECT_FILE_STORE[project_id]
-        results = await documents_service.search_all_user_files(query, project_files)
-        return JSONResponse(content={"results": results})
+        results = await documents_service.search_all_user_files(store_name, query, project_files)
+        return SearchResponse(results=results)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during search: {str(e)}") from e
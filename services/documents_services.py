@@ -1,12 +1,106 @@
-from io import BytesIO
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
 
+import aiofiles.os
 import magic
+from cachetools import TTLCache
 from fastapi import HTTPException, UploadFile
-from google.genai import types
+from google.genai import errors, types
+from tenacity import (
+    RetryCallState,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+)
 
-from app.common.constants import PROJECT_FILE_STORE, user_uuid
+from app.common import aio_file
+from app.common.constants import PROJECT_FILE_STORE, current_user_uuid
+from app.common.file_store import FileRecord
 from app.common.settings import settings
 
+logger = logging.getLogger(__name__)
+
+# Characters never allowed in an upload filename: path separators and
+# control characters, including NUL
+_UNSAFE_FILENAME_CHARS = re.compile(r"[/\\\x00-\x1f\x7f]")
+MAX_FILENAME_LENGTH = 255
+
+# Shared libmagic handle, so the magic database is loaded once per process.
+# Magic serializes calls with an internal lock, so it is safe across threads.
+_MIME = magic.Magic(mime=True)
+
+# Leading bytes handed to libmagic for MIME detection
+MIME_SNIFF_SIZE = 512
+# Container formats (OOXML zips, OLE2 compound files) whose document type
+# libmagic resolves from entries past the first 512 bytes
+_CONTAINER_MIME_TYPES = frozenset({
+    "application/zip",
+    "application/x-ole-storage",
+    "application/CDFV2",
+})
+_CONTAINER_SNIFF_SIZE = 8192
+# Non-standard MIME types some libmagic builds report, mapped to the
+# canonical type checked against settings.allowed_mime_types
+_MIME_ALIASES = {
+    "application/x-pdf": "application/pdf",
+    "application/acrobat": "application/pdf",
+}
+
+_backoff = wait_exponential(multiplier=0.25, max=settings.gemini_retry_max_wait)
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """
+    Check whether a failed Gemini call is worth retrying.
+    
+    Args:
+        error: Exception raised by the call.
+        
+    Returns:
+        bool: True for rate limits (429) and server errors (5xx).
+    """
+    return isinstance(error, errors.APIError) and (error.code == 429 or error.code >= 500)
+
+
+def _retry_wait(retry_state: RetryCallState) -> float:
+    """
+    Compute the delay before retrying a failed Gemini call.
+    
+    Honors the Retry-After header of the failed response when it holds a
+    number of seconds, and otherwise backs off exponentially. Either way
+    the delay is capped at the configured maximum wait.
+    
+    Args:
+        retry_state: State of the call being retried.
+        
+    Returns:
+        float: Seconds to wait before the next attempt.
+    """
+    error = retry_state.outcome.exception()
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        retry_after = float(headers.get('retry-after', ''))
+    except ValueError:
+        return _backoff(retry_state)
+    return min(max(retry_after, 0.0), settings.gemini_retry_max_wait)
+
+
+# Retries Gemini calls that hit rate limits or transient server errors
+_gemini_retry = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=_retry_wait,
+    stop=stop_after_attempt(settings.gemini_retry_attempts),
+    reraise=True,
+)
+
 
 class DocumentsService:
     """
@@ -22,7 +116,25 @@ class DocumentsService:
             client: Google Gemini API client instance.
         """
         self.client = client
-        self.file_search_store_name = None
+        # User ID -> name of that user's Gemini file search store
+        self._store_names: dict[str, str] = {}
+        self._generate_semaphore = asyncio.Semaphore(settings.gemini_generate_concurrency)
+        self._upload_semaphore = asyncio.Semaphore(settings.gemini_upload_concurrency)
+        # Store name -> {(content digest, filename): upload operation name}, for
+        # files already in that store
+        self._uploaded_files: dict[str, dict[tuple[str, str], str]] = {}
+        # (store name, content digest, filename) -> upload in progress, shared
+        # by concurrent requests uploading the same file
+        self._pending_uploads: dict[tuple[str, str, str], asyncio.Future] = {}
+        # Per-user state above, and the user's remote store, is dropped when
+        # the user leaves PROJECT_FILE_STORE
+        PROJECT_FILE_STORE.add_eviction_listener(self._forget_user)
+        self._pending_deletions: set[asyncio.Task] = set()
+        # Gemini responses keyed by store, request and file contents, so an
+        # upload never makes an entry stale
+        self._response_cache = TTLCache(
+            maxsize=settings.response_cache_size, ttl=settings.response_cache_ttl
+        )
 
     async def validate_documents(self, files: list[UploadFile]) -> bool:
         """
@@ -32,9 +144,15 @@ class DocumentsService:
         - Checks if files list is not empty
         - Validates file has a valid filename
         - Checks file extension against allowed list
-        - Verifies file size is within limits
-        - Detects and validates MIME type
-        - Stores valid files in PROJECT_FILE_STORE
+        - Verifies declared file size is within limits
+        - Stores valid files in PROJECT_FILE_STORE, checking MIME type and
+          actual size while each file is read
+        
+        Files are read concurrently once every file passes the checks that
+        need no I/O, and are only stored once all of them are read. If any
+        file fails, nothing is stored, the temporary files of the others are
+        removed and the error of the first failing file in upload order is
+        raised.
         
         Args:
             files: List of UploadFile objects to validate.
@@ -47,26 +165,54 @@ class DocumentsService:
             HTTPException(413): If file size exceeds maximum allowed size.
             HTTPException(415): If file type or MIME type is not supported.
         """
+        self._preflight(files)
+
+        with PROJECT_FILE_STORE.in_use(current_user_uuid.get()):
+            results = await asyncio.gather(
+                *(self._spool_file(file) for file in files), return_exceptions=True
+            )
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if errors:
+                await asyncio.gather(
+                    *(discard_local_copy(result) for result in results
+                      if isinstance(result, FileRecord))
+                )
+                raise errors[0]
+
+            for record in results:
+                await self._keep_file(record)
+
+        return True
+
+
+    def _preflight(self, files: list[UploadFile]) -> None:
+        """
+        Run the validation checks that need no I/O on every file.
+        
+        Called before any file is read, so a request with a bad file fails
+        without reading or storing anything.
+        
+        Args:
+            files: List of UploadFile objects to check.
+            
+        Raises:
+            HTTPException(400): If no files uploaded, or a filename is missing,
+                too long, "." or "..", or contains path separators or control
+                characters.
+            HTTPException(413): If a declared file size exceeds the limit.
+            HTTPException(415): If a file extension is not supported.
+        """
         if not files:
             raise HTTPException(status_code=400, detail="No files uploaded")
 
         for file in files:
-            if not file.filename:
+            if not file.filename or not _is_safe_filename(file.filename):
                 raise HTTPException(status_code=400, detail="Invalid file name")
             if not self._validate_extension(file.filename):
                 raise HTTPException(status_code=415, detail=f"Unsupported file type: {file.filename}")
             if not self._validate_size(file):
                 raise HTTPException(status_code=413, detail=f"File too large: {file.filename}")
 
-            mime_type = await self._get_mime_type(file)
-            if mime_type not in settings.allowed_mime_types:
-                raise HTTPException(status_code=415, detail=f"Unsupported MIME type: {mime_type}")
-
-            await self.store_project_files(file, mime_type)
-
-        return True
-
-
     def _validate_extension(self, filename: str) -> bool:
         """
         Validate file extension against allowed extensions list.
@@ -77,160 +223,523 @@ class DocumentsService:
         Returns:
             bool: True if extension is allowed, False otherwise.
         """
-        file_extension = filename.split(".")[-1].lower()
-        return file_extension in settings.allowed_extensions
+        return _is_allowed_extension(filename)
 
     def _validate_size(self, file: UploadFile) -> bool:
         """
-        Validate file size against maximum allowed size.
+        Validate declared file size against maximum allowed size.
+        
+        Files without a declared size pass here; their actual size is
+        checked while they are stored.
         
         Args:
             file: UploadFile object to check size.
             
         Returns:
-            bool: True if file size is within limit, False otherwise.
+            bool: True if file size is within limit or unknown, False otherwise.
         """
-        return file.size <= settings.max_file_size
+        return file.size is None or file.size <= settings.max_file_size
 
-    async def _get_mime_type(self, file: UploadFile) -> str:
+    async def _get_mime_type(self, file_header: bytes) -> str:
         """
-        Detect MIME type of uploaded file by reading file headers.
+        Detect MIME type of a file from its leading bytes.
         
-        Reads first 1KB of file to detect MIME type using python-magic library.
-        File pointer is reset after detection to allow further reading.
+        Uses the first 512 bytes of the file with python-magic library, which
+        is enough for most formats. Container formats such as docx are only
+        recognised as a generic container from that header, so those are
+        detected again from the first 8KB. Detection runs in a worker thread
+        so libmagic does not block the event loop. Known aliases are mapped
+        to their canonical type.
         
         Args:
-            file: UploadFile object to detect MIME type.
+            file_header: Leading bytes of the file.
             
         Returns:
             str: Detected MIME type (e.g., 'application/pdf', 'text/plain').
         """
-        file_header = await file.read(1024)  # Read first 1KB for MIME type detection
-        detected_mime = magic.from_buffer(file_header, mime=True)
-        await file.seek(0)  # Reset file pointer after reading
-        return detected_mime
+        detected_mime = await asyncio.to_thread(_MIME.from_buffer, file_header[:MIME_SNIFF_SIZE])
+        if detected_mime in _CONTAINER_MIME_TYPES and len(file_header) > MIME_SNIFF_SIZE:
+            detected_mime = await asyncio.to_thread(
+                _MIME.from_buffer, file_header[:_CONTAINER_SNIFF_SIZE]
+            )
+        return _MIME_ALIASES.get(detected_mime, detected_mime)
 
     async def ensure_store_exists(self) -> str:
         """
-        Ensure a Gemini file search store exists for the project.
+        Ensure a Gemini file search store exists for the current user.
         
-        Creates a new file search store if one doesn't exist yet, or returns
-        the existing store name. The store is used to upload and search documents.
+        Each user gets their own store, so one user's searches never see
+        another user's documents. Creates the store if the user doesn't have
+        one yet, or returns the existing store name.
         
         Returns:
-            str: Name/ID of the file search store in Gemini.
+            str: Name/ID of the user's file search store in Gemini.
         """
-        if self.file_search_store_name is None:
-            store_display_name = f"project_store_{user_uuid}"
+        user_uuid = current_user_uuid.get()
+        store_name = self._store_names.get(user_uuid)
+        if store_name is None:
             store = await self.client.file_search_stores.create(
-                config={'display_name': store_display_name}
+                config={'display_name': f"project_store_{user_uuid}"}
             )
-            self.file_search_store_name = store.name
+            store_name = self._store_names.setdefault(user_uuid, store.name)
+            if store_name != store.name:
+                # A concurrent request created the user's store first
+                await self._delete_store(store.name)
 
-        return self.file_search_store_name
+        return store_name
 
-    async def store_project_files(self, file: UploadFile, mime_type: str) -> None:
+    def _forget_user(self, user_uuid: str) -> None:
         """
-        Store uploaded file in memory (PROJECT_FILE_STORE).
+        Drop the state kept for a user evicted from PROJECT_FILE_STORE.
+        
+        The user's Gemini file search store is deleted in the background, so
+        stores of users who never come back do not pile up remotely.
         
-        Files are stored temporarily in memory with their content and metadata.
+        Args:
+            user_uuid: ID of the evicted user.
+        """
+        store_name = self._store_names.pop(user_uuid, None)
+        if store_name is None:
+            return
+        self._uploaded_files.pop(store_name, None)
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            logger.warning("No event loop to delete file search store %s on", store_name)
+            return
+        deletion = loop.create_task(self._delete_store(store_name))
+        self._pending_deletions.add(deletion)
+        deletion.add_done_callback(self._pending_deletions.discard)
+
+    async def _delete_store(self, store_name: str) -> None:
+        """
+        Delete a Gemini file search store together with its documents.
+        
+        Failures are logged rather than raised, as nobody waits on the deletion.
+        
+        Args:
+            store_name: Name/ID of the file search store to delete.
+        """
+        try:
+            await self.client.file_search_stores.delete(name=store_name, config={'force': True})
+        except errors.APIError:
+            logger.warning("Could not delete file search store %s", store_name, exc_info=True)
+
+    def get_store_name(self, user_uuid: str) -> str | None:
+        """
+        Look up the file search store of a user.
+        
+        Args:
+            user_uuid: User ID, as returned in project_id by /brief.
+            
+        Returns:
+            str | None: Name/ID of the user's store, or None if the user has
+            not uploaded any files yet.
+        """
+        return self._store_names.get(user_uuid)
+
+    async def store_project_files(self, file: UploadFile) -> None:
+        """
+        Store uploaded file in PROJECT_FILE_STORE.
+        
+        The store keeps the temporary file path and a content digest alongside
+        the file metadata. A file with the same name replaces the previously
+        stored one.
         In production, this should be replaced with blob storage (S3, GCS, etc.).
         
         Args:
             file: UploadFile object to store.
-            mime_type: MIME type of the file.
-        """
-        if user_uuid not in PROJECT_FILE_STORE:
-            PROJECT_FILE_STORE[user_uuid] = []
-
-        file_content = await file.read()
-        PROJECT_FILE_STORE[user_uuid].append(
-            {
-                'filename': file.filename,
-                'content': file_content,
-                'mime_type': mime_type
-            }
+            
+        Raises:
+            HTTPException(413): If file size exceeds maximum allowed size.
+            HTTPException(415): If MIME type is not supported.
+        """
+        await self._keep_file(await self._spool_file(file))
+
+    async def _spool_file(self, file: UploadFile) -> FileRecord:
+        """
+        Read an upload into a temporary file without storing it.
+        
+        The upload is read once, streamed in bounded chunks into a temporary
+        file on disk, so file contents never stay resident in memory. The MIME
+        type is detected from the first chunk and the size is checked as chunks
+        arrive, so invalid files are rejected without reading them any further.
+        
+        Args:
+            file: UploadFile object to read.
+            
+        Returns:
+            FileRecord: Record of the temporary file, its metadata and digest.
+            
+        Raises:
+            HTTPException(413): If file size exceeds maximum allowed size.
+            HTTPException(415): If MIME type is not supported.
+        """
+        file_size = 0
+        file_digest = hashlib.blake2b()
+        fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(file.filename)[1])
+        os.close(fd)
+        try:
+            async with aio_file.open(tmp_path, 'wb') as tmp_file:
+                chunk = await file.read(aio_file.BLOCK_SIZE)
+                mime_type = await self._get_mime_type(chunk)
+                if mime_type not in settings.allowed_mime_types:
+                    raise HTTPException(status_code=415, detail=f"Unsupported MIME type: {mime_type}")
+                while chunk:
+                    file_size += len(chunk)
+                    if file_size > settings.max_file_size:
+                        raise HTTPException(status_code=413, detail=f"File too large: {file.filename}")
+                    await tmp_file.write(chunk)
+                    file_digest.update(chunk)
+                    chunk = await file.read(aio_file.BLOCK_SIZE)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                await aiofiles.os.remove(tmp_path)
+            raise
+
+        return FileRecord(
+            filename=file.filename,
+            path=tmp_path,
+            mime_type=mime_type,
+            size=file_size,
+            digest=file_digest.hexdigest()
         )
 
+    async def _keep_file(self, record: FileRecord) -> None:
+        """
+        Add a spooled file to the current user's PROJECT_FILE_STORE entry.
+        
+        Args:
+            record: FileRecord returned by _spool_file.
+        """
+        project_files = PROJECT_FILE_STORE.setdefault(current_user_uuid.get(), {})
+        previous_record = project_files.get(record.filename)
+        project_files[record.filename] = record
+        if previous_record is not None:
+            await discard_local_copy(previous_record)
+
     async def upload_files_to_store(self) -> str:
         """
         Upload all user files to Gemini file search store.
         
         Takes files from PROJECT_FILE_STORE and uploads them to the Gemini
-        file search store for semantic search capabilities.
+        file search store for semantic search capabilities. Uploads run
+        concurrently, bounded by the configured upload concurrency. Files
+        already in the user's store under the same name and contents are not
+        uploaded again; a copy under a new name is uploaded, so every listed
+        filename exists in the store. A file already being uploaded by a
+        concurrent request is awaited rather than uploaded twice. Once a file
+        is handled its temporary file is removed; until then the user is kept from being evicted from
+        PROJECT_FILE_STORE.
         
         Returns:
             str: Name/ID of the file search store containing uploaded files.
         """
-        store_name = await self.ensure_store_exists()
+        user_uuid = current_user_uuid.get()
+        # Keep the user's temporary files from being evicted until they are uploaded
+        with PROJECT_FILE_STORE.in_use(user_uuid):
+            store_name = await self.ensure_store_exists()
+            project_files = PROJECT_FILE_STORE.get(user_uuid, {})
+            uploaded_files = self._uploaded_files.setdefault(store_name, {})
 
-        for file_data in PROJECT_FILE_STORE.get(user_uuid, []):
-            file_stream = BytesIO(file_data['content'])
-            file_stream.name = file_data['filename']
+            async def _release(record: FileRecord) -> None:
+                uploaded_record = await discard_local_copy(record)
+                # Keep a newer upload of the same filename stored meanwhile
+                if project_files.get(record.filename) is record:
+                    project_files[record.filename] = uploaded_record
 
-            await self.client.file_search_stores.upload_to_file_search_store(
-                file_search_store_name=store_name,
-                file=file_stream,
-                config={
-                    'mime_type': file_data['mime_type'],
-                    'display_name': file_data['filename']
-                }
+            async def _upload(record: FileRecord) -> None:
+                key = (store_name, record.digest, record.filename)
+                upload = self._pending_uploads.get(key)
+                if upload is None:
+                    upload = asyncio.ensure_future(self._upload_file(store_name, record))
+                    self._pending_uploads[key] = upload
+                    upload.add_done_callback(functools.partial(self._finish_upload, key))
+                # Shielded so a cancelled request does not cancel an upload
+                # other requests are waiting on
+                await asyncio.shield(upload)
+                await _release(record)
+
+            new_records: list[FileRecord] = []
+            duplicate_records: list[FileRecord] = []
+            for record in project_files.values():
+                if record.path is None:
+                    continue
+                if (record.digest, record.filename) in uploaded_files:
+                    duplicate_records.append(record)
+                else:
+                    new_records.append(record)
+
+            await asyncio.gather(
+                *(_upload(record) for record in new_records),
+                *(_release(record) for record in duplicate_records),
             )
 
         return store_name
 
-    async def search_individual_file(self, query: str, file_info: dict) -> dict:
+    def _finish_upload(self, key: tuple[str, str, str], upload: asyncio.Future) -> None:
         """
-        Search a single file using Gemini AI.
+        Record a finished upload, so the same file is not uploaded again.
         
-        Uses Gemini's file search capability to find relevant information
-        in a specific document based on the query.
+        Runs as a done callback, before any request awaiting the upload resumes.
         
         Args:
-            query: Search query string.
-            file_info: Dictionary containing file metadata (filename, content, mime_type).
+            key: Store name, content digest and filename of the upload.
+            upload: Finished upload.
+        """
+        del self._pending_uploads[key]
+        if upload.cancelled() or upload.exception() is not None:
+            return
+        store_name, digest, filename = key
+        uploaded_files = self._uploaded_files.get(store_name)
+        # The store's user may have been evicted meanwhile
+        if uploaded_files is not None:
+            uploaded_files[(digest, filename)] = upload.result().name
+
+    async def generate_brief(self, store_name: str, project_files: dict[str, FileRecord]) -> str:
+        """
+        Generate a concise brief of the project files using Gemini AI.
+        
+        Briefs are cached per store and set of file contents, so repeating
+        a request for the same files does not call Gemini again. Empty
+        replies are not cached.
+        
+        Args:
+            store_name: Name/ID of the file search store holding the files.
+            project_files: Mapping of filename to FileRecord.
             
         Returns:
-            dict: Dictionary with 'filename' and 'snippet' keys containing search results.
-        """
-        response = await self.client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=query,
-            config=types.GenerateContentConfig(
-                tools=[
-                    types.Tool(
-                        file_search=types.FileSearch(
-                            file_search_store_names=[self.file_search_store_name]
-                        )
-                    )
-                ]
-            )
-        )
+            str: AI-generated summary of the documents, empty if Gemini
+            returned no text.
+        """
+        cache_key = ('brief', store_name, _project_files_key(project_files))
+        # A single lookup, as an entry may expire between a check and a read
+        cached_brief = self._response_cache.get(cache_key)
+        if cached_brief is not None:
+            return cached_brief
 
-        return {
-            "filename": file_info['filename'],
-            "snippet": response.text
-        }
+        prompt = f"Provide a concise brief for the following documents: {', '.join(project_files)}"
+        response = await self._generate_content(store_name, prompt)
+        # Gemini returns no text when a reply is blocked or has no candidates
+        brief = response.text or ""
 
+        if brief:
+            self._response_cache[cache_key] = brief
+        return brief
 
-    async def search_all_user_files(self, query: str, project_files: list[dict]) -> list[dict]:
+    async def search_all_user_files(
+        self, store_name: str, query: str, project_files: dict[str, FileRecord]
+    ) -> list[dict]:
         """
         Search across all user files using Gemini AI.
         
-        Iterates through all project files and searches each one for relevant
-        information based on the query.
+        Issues a single file search request against the store, asking Gemini
+        for a JSON array with one snippet per file. If the reply is not valid
+        JSON, the whole answer is returned as the snippet of every file.
+        Results are cached per store, query and set of file contents, unless
+        the reply is empty.
         
         Args:
+            store_name: Name/ID of the file search store holding the files.
             query: Search query string.
-            project_files: List of file metadata dictionaries.
+            project_files: Mapping of filename to FileRecord.
             
         Returns:
             list[dict]: List of search results, each containing filename and snippet.
         """
-        results = []
-        for file_info in project_files:
-            result = await self.search_individual_file(query, file_info)
-            if result:
-                results.append(result)
+        if not project_files:
+            return []
+
+        cache_key = ('search', store_name, query, _project_files_key(project_files))
+        cached_results = self._response_cache.get(cache_key)
+        if cached_results is not None:
+            return cached_results
+
+        prompt = (
+            f"Answer this query using the documents in the file search store: {query}\n"
+            f"Files: {', '.join(project_files)}\n"
+            "Reply with only a JSON array containing one object per file, with a "
+            "'filename' key and a 'snippet' key holding the answer found in that file."
+        )
+        response = await self._generate_content(store_name, prompt)
+        answer = response.text or ""
+
+        results = _parse_search_results(answer, project_files)
+        if results is None:
+            results = [
+                {"filename": filename, "snippet": answer}
+                for filename in project_files
+            ]
 
+        if answer:
+            self._response_cache[cache_key] = results
         return results
+
+    @_gemini_retry
+    async def _generate_content(self, store_name: str, prompt: str) -> types.GenerateContentResponse:
+        """
+        Send a prompt to Gemini with file search enabled on a store.
+        
+        Calls are bounded by the configured generate concurrency and retried
+        with backoff on rate limits and transient server errors.
+        
+        Args:
+            store_name: Name/ID of the file search store to search.
+            prompt: Prompt to send.
+            
+        Returns:
+            types.GenerateContentResponse: Gemini response.
+        """
+        async with self._generate_semaphore:
+            return await self.client.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=prompt,
+                config=_build_config(store_name)
+            )
+
+    @_gemini_retry
+    async def _upload_file(self, store_name: str, record: FileRecord) -> types.UploadToFileSearchStoreOperation:
+        """
+        Upload a stored file to the Gemini file search store.
+        
+        Uploads are bounded by the configured upload concurrency and retried
+        with backoff on rate limits and transient server errors.
+        
+        Args:
+            store_name: Name/ID of the file search store.
+            record: FileRecord whose local copy is uploaded.
+            
+        Returns:
+            types.UploadToFileSearchStoreOperation: Upload operation.
+        """
+        async with self._upload_semaphore:
+            return await self.client.file_search_stores.upload_to_file_search_store(
+                file_search_store_name=store_name,
+                file=record.path,
+                config={
+                    'mime_type': record.mime_type,
+                    'display_name': record.filename
+                }
+            )
+
+
+@functools.lru_cache(maxsize=128)
+def _build_config(store_name: str) -> types.GenerateContentConfig:
+    """
+    Build the Gemini request config that enables file search on a store.
+    
+    Built once per store and reused across requests.
+    
+    Args:
+        store_name: Name/ID of the file search store to search.
+        
+    Returns:
+        types.GenerateContentConfig: Config with the file search tool attached.
+    """
+    return types.GenerateContentConfig(
+        tools=[
+            types.Tool(
+                file_search=types.FileSearch(
+                    file_search_store_names=[store_name]
+                )
+            )
+        ]
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _is_allowed_extension(filename: str) -> bool:
+    """
+    Check a filename's extension against the allowed extensions.
+    
+    Memoized per filename, since clients tend to re-send the same files.
+    
+    Args:
+        filename: Name of the file to check.
+        
+    Returns:
+        bool: True if extension is allowed, False otherwise.
+    """
+    _, dot, file_extension = filename.rpartition(".")
+    return bool(dot) and file_extension.lower() in settings.allowed_extensions
+
+
+def _is_safe_filename(filename: str) -> bool:
+    """
+    Check a filename cannot escape the upload directory or corrupt logs.
+    
+    Any punctuation is allowed; only path separators, "." and ".." names,
+    control characters and overlong names are rejected.
+    
+    Args:
+        filename: Name of the uploaded file.
+        
+    Returns:
+        bool: True if the filename is safe to use.
+    """
+    return (
+        len(filename) <= MAX_FILENAME_LENGTH
+        and filename not in ('.', '..')
+        and not _UNSAFE_FILENAME_CHARS.search(filename)
+    )
+
+
+def _parse_search_results(text: str, project_files: dict[str, FileRecord]) -> list[dict] | None:
+    """
+    Parse the JSON array of per-file snippets returned by a search request.
+    
+    Args:
+        text: Raw response text, optionally wrapped in a Markdown code fence.
+        project_files: Mapping of filename to FileRecord that was searched.
+        
+    Returns:
+        list[dict] | None: Results for known files, or None if the text is not
+        a JSON array.
+    """
+    text = text.strip().removeprefix("```json").strip("`").strip()
+    try:
+        items = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(items, list):
+        return None
+
+    return [
+        {"filename": item["filename"], "snippet": str(item.get("snippet", ""))}
+        for item in items
+        if isinstance(item, dict) and item.get("filename") in project_files
+    ]
+
+
+def _project_files_key(project_files: dict[str, FileRecord]) -> str:
+    """
+    Build a cache key identifying a set of project files by name and content.
+    
+    Args:
+        project_files: Mapping of filename to FileRecord.
+        
+    Returns:
+        str: Hex digest that is independent of file order.
+    """
+    key = hashlib.blake2b()
+    for filename in sorted(project_files):
+        key.update(f"{filename}\0{project_files[filename].digest}\0".encode())
+    return key.hexdigest()
+
+
+async def discard_local_copy(record: FileRecord) -> FileRecord:
+    """
+    Remove the temporary file backing a stored file, if any.
+    
+    Args:
+        record: FileRecord from PROJECT_FILE_STORE.
+        
+    Returns:
+        FileRecord: The same record with its path cleared, so it is not
+        uploaded again.
+    """
+    if record.path is not None:
+        with contextlib.suppress(FileNotFoundError):
+            await aiofiles.os.remove(record.path)
+    return record._replace(path=None)
@@ -1,45 +1,146 @@
 """
 Pytest configuration and shared fixtures for all tests.
 """
+import contextlib
 import io
-from unittest.mock import AsyncMock, MagicMock
+import os
+import uuid
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, Mock
 
+import httpx
 import pytest
+import pytest_asyncio
+from fastapi import UploadFile
 from fastapi.testclient import TestClient
+from google.genai import errors
+
+from app.common.constants import current_user_uuid
+from app.common.file_store import FileRecord
 
 # Configure pytest-asyncio
 pytest_plugins = ('pytest_asyncio',)
 
+# Upload contents, built once at import
+_VALID_PDF_BYTES = b"%PDF-1.4\n%\xE2\xE3\xCF\xD3\n" + b"test content" * 100  # PDF magic bytes
+_VALID_TXT_BYTES = b"This is a plain text file with some content."
+_EXE_BYTES = b"malicious content"
+_JPEG_BYTES = b"\xff\xd8\xff\xe0" + b"fake jpeg"
+
+
+class FakeFileSearchStores:
+    """
+    Plain stand-in for the async file search stores API.
+    
+    Tests that assert on calls replace a method with an AsyncMock.
+    """
+    
+    async def create(self, **kwargs):
+        return SimpleNamespace(name="test-store-name")
+    
+    async def upload_to_file_search_store(self, **kwargs):
+        return SimpleNamespace(name="test-upload-operation")
+    
+    async def delete(self, **kwargs):
+        return None
+
+
+class FakeModels:
+    """Plain stand-in for the async models API."""
+    
+    async def generate_content(self, **kwargs):
+        return SimpleNamespace(text="")
+
 
 @pytest.fixture
 def mock_gemini_client():
-    """Mock Gemini API client."""
-    client = MagicMock()
-    client.aio = MagicMock()
-    client.aio.file_search_stores = MagicMock()
-    client.aio.models = MagicMock()
-    return client
+    """Fresh fake Gemini API client, so replaced methods never leak between tests."""
+    return SimpleNamespace(aio=SimpleNamespace(
+        file_search_stores=FakeFileSearchStores(),
+        models=FakeModels(),
+    ))
+
+
+@pytest.fixture(scope="session")
+def client():
+    """
+    Synchronous client for the plain health checks.
+    
+    Entered as a context manager, so the application lifespan runs once
+    for the whole session.
+    """
+    from app.main import app
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def documents_service(mock_gemini_client):
+    """
+    Create DocumentsService instance for testing.
+    
+    Function scoped: the service holds response caches, upload digests and
+    semaphores that must not carry over between tests.
+    """
+    from services.documents_services import DocumentsService
+    return DocumentsService(mock_gemini_client.aio)
+
+
+@pytest_asyncio.fixture(scope="session")
+async def async_client():
+    """Async HTTP client calling the application in-process, shared by the session."""
+    from app.main import app
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
 
 
 @pytest.fixture
 def mock_file_search_store():
     """Mock file search store response."""
-    store = MagicMock()
-    store.name = "projects/test-project/locations/us/fileSearchStores/test-store-123"
-    return store
+    return SimpleNamespace(name="projects/test-project/locations/us/fileSearchStores/test-store-123")
 
 
 @pytest.fixture
 def mock_generate_content_response():
     """Mock Gemini generate_content response."""
-    response = MagicMock()
-    response.text = "This is a test response from Gemini API."
-    return response
+    return SimpleNamespace(text="This is a test response from Gemini API.")
 
 
 @pytest.fixture
+def create_api_error():
+    """Factory fixture to create Gemini API errors."""
+    def _create_error(code: int, headers: dict | None = None) -> errors.APIError:
+        """
+        Create a Gemini API error as raised by the client.
+        
+        Args:
+            code: HTTP status code
+            headers: Response headers
+        """
+        error_class = errors.ClientError if code < 500 else errors.ServerError
+        return error_class(
+            code,
+            {'error': {'code': code, 'message': 'Test error', 'status': 'TEST'}},
+            httpx.Response(code, headers=headers)
+        )
+    
+    return _create_error
+
+
+@pytest.fixture
+def retry_sleep(monkeypatch):
+    """Skip backoff waits between retried Gemini calls, recording them."""
+    from services.documents_services import DocumentsService
+    sleep = AsyncMock()
+    monkeypatch.setattr(DocumentsService._generate_content.retry, 'sleep', sleep)
+    monkeypatch.setattr(DocumentsService._upload_file.retry, 'sleep', sleep)
+    return sleep
+
+
+@pytest.fixture(scope="session")
 def create_mock_upload_file():
-    """Factory fixture to create mock UploadFile instances."""
+    """Factory fixture to create mock UploadFile instances, specced so misused attributes raise."""
     def _create_file(
         filename: str = "test.pdf",
         content: bytes = b"test content",
@@ -55,7 +156,7 @@ def create_mock_upload_file():
             content_type: MIME type
             size: File size (defaults to len(content))
         """
-        file = MagicMock()
+        file = Mock(spec=UploadFile)
         file.filename = filename
         file.content_type = content_type
         file.size = size if size is not None else len(content)
@@ -63,16 +164,9 @@ def create_mock_upload_file():
         # Create a BytesIO object that can be read multiple times
         file_io = io.BytesIO(content)
         
-        # Mock read to return content and allow multiple reads
-        async def mock_read(size=-1):
-            return file_io.read(size)
-        
-        # Mock seek to reset position
-        async def mock_seek(position):
-            return file_io.seek(position)
-        
-        file.read = mock_read
-        file.seek = mock_seek
+        # Awaitable read/seek backed by the BytesIO, recording their calls
+        file.read = AsyncMock(wraps=file_io.read)
+        file.seek = AsyncMock(wraps=file_io.seek)
         file.file = file_io
         
         return file
@@ -83,25 +177,22 @@ def create_mock_upload_file():
 @pytest.fixture
 def valid_pdf_file(create_mock_upload_file):
     """Create a valid PDF file for testing."""
-    # PDF magic bytes
-    pdf_content = b"%PDF-1.4\n%\xE2\xE3\xCF\xD3\n" + b"test content" * 100
     return create_mock_upload_file(
         filename="document.pdf",
-        content=pdf_content,
+        content=_VALID_PDF_BYTES,
         content_type="application/pdf",
-        size=len(pdf_content)
+        size=len(_VALID_PDF_BYTES)
     )
 
 
 @pytest.fixture
 def valid_txt_file(create_mock_upload_file):
     """Create a valid text file for testing."""
-    txt_content = b"This is a plain text file with some content."
     return create_mock_upload_file(
         filename="document.txt",
-        content=txt_content,
+        content=_VALID_TXT_BYTES,
         content_type="text/plain",
-        size=len(txt_content)
+        size=len(_VALID_TXT_BYTES)
     )
 
 
@@ -110,21 +201,25 @@ def invalid_extension_file(create_mock_upload_file):
     """Create a file with invalid extension."""
     return create_mock_upload_file(
         filename="document.exe",
-        content=b"malicious content",
+        content=_EXE_BYTES,
         content_type="application/x-msdownload",
         size=100
     )
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def oversized_file(create_mock_upload_file):
-    """Create a file that exceeds size limit."""
-    large_content = b"x" * (20 * 1024 * 1024)  # 20MB
+    """
+    Create a file that declares a size over the limit.
+    
+    Oversized files are rejected on their declared size before any read,
+    so the file holds no content. Shared across the session.
+    """
     return create_mock_upload_file(
         filename="large.pdf",
-        content=large_content,
+        content=b"",
         content_type="application/pdf",
-        size=len(large_content)
+        size=20 * 1024 * 1024  # 20MB
     )
 
 
@@ -133,7 +228,7 @@ def invalid_mime_type_file(create_mock_upload_file):
     """Create a file with invalid MIME type."""
     return create_mock_upload_file(
         filename="image.jpg",
-        content=b"\xff\xd8\xff\xe0" + b"fake jpeg",
+        content=_JPEG_BYTES,
         content_type="image/jpeg",
         size=100
     )
@@ -141,31 +236,58 @@ def invalid_mime_type_file(create_mock_upload_file):
 
 @pytest.fixture
 def test_user_uuid():
-    """Consistent test user UUID."""
-    return "test-user-12345"
+    """Unique test user UUID, set as the user of the current request."""
+    user_uuid = str(uuid.uuid4())
+    token = current_user_uuid.set(user_uuid)
+    yield user_uuid
+    current_user_uuid.reset(token)
 
 
 @pytest.fixture
-def sample_project_files():
+def sample_project_files(tmp_path):
     """Sample project files for testing."""
-    return [
-        {
-            'filename': 'doc1.pdf',
-            'content': b'PDF content here',
-            'mime_type': 'application/pdf'
-        },
-        {
-            'filename': 'doc2.txt',
-            'content': b'Text content here',
-            'mime_type': 'text/plain'
-        }
-    ]
+    pdf_path = tmp_path / 'doc1.pdf'
+    pdf_path.write_bytes(b'PDF content here')
+    txt_path = tmp_path / 'doc2.txt'
+    txt_path.write_bytes(b'Text content here')
+    return {
+        'doc1.pdf': FileRecord(
+            filename='doc1.pdf',
+            path=str(pdf_path),
+            mime_type='application/pdf',
+            size=16,
+            digest='digest-doc1'
+        ),
+        'doc2.txt': FileRecord(
+            filename='doc2.txt',
+            path=str(txt_path),
+            mime_type='text/plain',
+            size=17,
+            digest='digest-doc2'
+        )
+    }
 
 
 @pytest.fixture(autouse=True)
 def reset_project_store():
-    """Reset PROJECT_FILE_STORE before each test."""
+    """Reset PROJECT_FILE_STORE before each test, removing stored temp files."""
     from app.common.constants import PROJECT_FILE_STORE
-    PROJECT_FILE_STORE.clear()
+    if PROJECT_FILE_STORE:
+        PROJECT_FILE_STORE.clear()
     yield
+    if not PROJECT_FILE_STORE:
+        return
+    for project_files in PROJECT_FILE_STORE.values():
+        for record in project_files.values():
+            if record.path:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(record.path)
     PROJECT_FILE_STORE.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_extension_cache():
+    """Clear the memoised extension checks after each test."""
+    yield
+    from services.documents_services import _is_allowed_extension
+    _is_allowed_extension.cache_clear()
@@ -6,52 +6,104 @@ Tests are organized by endpoint:
 - TestSearchEndpoint: Tests for /documents/search
 - TestHealthEndpoint: Tests for health check endpoints
 """
+import io
+from types import SimpleNamespace
+
 import pytest
-from unittest.mock import AsyncMock, MagicMock, patch
-from fastapi.testclient import TestClient
+from unittest.mock import AsyncMock, MagicMock
+from fastapi import UploadFile
 
 from app.main import app
 from app.common.constants import PROJECT_FILE_STORE
+from app.common.file_store import FileRecord
+from app.common.dependencies import get_documents_service
+from app.common.settings import settings
+from app.router.documents_router import generate_brief, search_store
+from services.documents_services import DocumentsService
+
+
+@pytest.fixture(scope="module")
+def documents_service_override():
+    """Replace the lifespan-managed DocumentsService with one mock for the module."""
+    mock_service = MagicMock()
+    app.dependency_overrides[get_documents_service] = lambda: mock_service
+    yield mock_service
+    app.dependency_overrides.clear()
 
 
-client = TestClient(app)
+@pytest.fixture(autouse=True)
+def mock_documents_service(documents_service_override):
+    """Shared DocumentsService mock, with configured results cleared before each test."""
+    documents_service_override.reset_mock(return_value=True, side_effect=True)
+    return documents_service_override
 
 
 class TestHealthEndpoints:
     """Test suite for health check endpoints."""
     
-    def test_root_endpoint(self):
+    def test_root_endpoint(self, client):
         """Test root endpoint returns welcome message."""
         response = client.get("/")
         assert response.status_code == 200
         assert "message" in response.json()
         assert "Agile Monkeys" in response.json()["message"]
     
-    def test_health_check_endpoint(self):
+    def test_health_check_endpoint(self, client):
         """Test health check endpoint."""
         response = client.get("/health")
         assert response.status_code == 200
         assert response.json() == {"status": "healthy"}
 
 
+class TestUserIdMiddleware:
+    """Test suite for per-request user identification."""
+    
+    async def test_user_id_header_is_echoed(self, async_client, test_user_uuid):
+        """Test the X-User-Id of the request is returned in the response."""
+        response = await async_client.get("/health", headers={"X-User-Id": test_user_uuid})
+        assert response.headers["X-User-Id"] == test_user_uuid
+    
+    async def test_user_id_is_normalized(self, async_client, test_user_uuid):
+        """Test a UUID in another accepted form is returned in canonical form."""
+        response = await async_client.get("/health", headers={"X-User-Id": test_user_uuid.upper()})
+        assert response.headers["X-User-Id"] == test_user_uuid
+    
+    @pytest.mark.parametrize("user_id", ["alice", "../../etc", "x" * 200])
+    async def test_malformed_user_id_is_rejected(self, async_client, user_id):
+        """Test an X-User-Id that is not a UUID is rejected before reaching the endpoint."""
+        response = await async_client.get("/health", headers={"X-User-Id": user_id})
+        
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Invalid X-User-Id header"
+    
+    async def test_user_id_is_generated_when_missing(self, async_client):
+        """Test each request without X-User-Id gets a new user id."""
+        first = (await async_client.get("/health")).headers["X-User-Id"]
+        second = (await async_client.get("/health")).headers["X-User-Id"]
+        assert first and second and first != second
+
+
+class TestLifespan:
+    """Test suite for application startup and shutdown."""
+    
+    def test_lifespan_creates_documents_service(self, client):
+        """Test startup attaches a DocumentsService to the application state."""
+        assert isinstance(client.app.state.documents_service, DocumentsService)
+
+
 class TestBriefEndpoint:
     """Test suite for /documents/brief endpoint."""
     
-    @pytest.fixture
-    def mock_documents_service(self):
-        """Mock DocumentsService for router tests."""
-        with patch('app.router.documents_router.documents_service') as mock_service:
-            yield mock_service
-    
     @pytest.fixture
     def mock_gemini_response(self):
         """Mock Gemini API response."""
-        response = MagicMock()
-        response.text = "This document discusses machine learning algorithms and their applications."
-        return response
+        return SimpleNamespace(
+            text="This document discusses machine learning algorithms and their applications."
+        )
     
-    def test_generate_brief_success(
-        self, 
+    async def test_generate_brief_success(
+        self,
+        async_client,
         mock_documents_service,
         mock_gemini_response,
         valid_pdf_file,
@@ -64,46 +116,44 @@ class TestBriefEndpoint:
             return_value="test-store-name"
         )
         
-        with patch('app.router.documents_router.client') as mock_client:
-            mock_client.models.generate_content = AsyncMock(return_value=mock_gemini_response)
-            
-            with patch('app.common.constants.user_uuid', test_user_uuid):
-                # Prepare file for upload
-                PROJECT_FILE_STORE[test_user_uuid] = [{
-                    'filename': 'test.pdf',
-                    'content': b'test content',
-                    'mime_type': 'application/pdf'
-                }]
-                
-                # Make request
-                with open('/tmp/test.pdf', 'wb') as f:
-                    f.write(b'%PDF-1.4 test content')
-                
-                with open('/tmp/test.pdf', 'rb') as f:
-                    response = client.post(
-                        "/documents/documents/brief",
-                        files={"files": ("test.pdf", f, "application/pdf")}
-                    )
-                
-                assert response.status_code == 200
-                data = response.json()
-                assert "project_id" in data
-                assert "store_name" in data
-                assert "brief" in data
+        mock_documents_service.generate_brief = AsyncMock(return_value=mock_gemini_response.text)
+        
+        # Prepare file for upload
+        PROJECT_FILE_STORE[test_user_uuid] = {'test.pdf': FileRecord(
+            filename='test.pdf',
+            path=None,
+            mime_type='application/pdf',
+            size=12,
+            digest='digest-test'
+        )}
+        
+        # Make request
+        response = await async_client.post(
+            "/documents/documents/brief",
+            files={"files": ("test.pdf", io.BytesIO(b'%PDF-1.4 test content'), "application/pdf")},
+            headers={"X-User-Id": test_user_uuid}
+        )
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data["project_id"] == test_user_uuid
+        assert "store_name" in data
+        assert data["brief"] == mock_gemini_response.text
     
-    def test_generate_brief_no_files(self, mock_documents_service):
+    async def test_generate_brief_no_files(self, async_client, mock_documents_service):
         """Test brief generation fails with no files."""
         mock_documents_service.validate_documents = AsyncMock(
             side_effect=Exception("No files uploaded")
         )
         
-        response = client.post("/documents/documents/brief", files={})
+        response = await async_client.post("/documents/documents/brief", files={})
         
         # FastAPI returns 422 for validation errors on missing required fields
         assert response.status_code == 422
     
-    def test_generate_brief_validation_error(
-        self, 
+    async def test_generate_brief_validation_error(
+        self,
+        async_client,
         mock_documents_service,
         invalid_extension_file
     ):
@@ -114,29 +164,33 @@ class TestBriefEndpoint:
             side_effect=HTTPException(status_code=415, detail="Unsupported file type")
         )
         
-        with open('/tmp/test.exe', 'wb') as f:
-            f.write(b'malicious content')
-        
-        with open('/tmp/test.exe', 'rb') as f:
-            response = client.post(
-                "/documents/documents/brief",
-                files={"files": ("malware.exe", f, "application/x-msdownload")}
-            )
+        response = await async_client.post(
+            "/documents/documents/brief",
+            files={"files": ("malware.exe", io.BytesIO(b'malicious content'), "application/x-msdownload")}
+        )
         
         assert response.status_code == 415
 
+    
+    async def test_generate_brief_content_length_too_large(self, async_client, mock_documents_service):
+        """Test bodies declared larger than the request limit are rejected before being read."""
+        mock_documents_service.validate_documents = AsyncMock(return_value=True)
+        
+        response = await async_client.post(
+            "/documents/documents/brief",
+            files={"files": ("test.pdf", b"%PDF-1.4 test content", "application/pdf")},
+            headers={"content-length": str(settings.max_request_size + 1)}
+        )
+        
+        assert response.status_code == 413
+        mock_documents_service.validate_documents.assert_not_called()
 
 class TestSearchEndpoint:
     """Test suite for /documents/search endpoint."""
     
-    @pytest.fixture
-    def mock_documents_service(self):
-        """Mock DocumentsService for router tests."""
-        with patch('app.router.documents_router.documents_service') as mock_service:
-            yield mock_service
-    
-    def test_search_store_success(
-        self, 
+    async def test_search_store_success(
+        self,
+        async_client,
         mock_documents_service,
         test_user_uuid,
         sample_project_files
@@ -151,70 +205,63 @@ class TestSearchEndpoint:
             return_value=search_results
         )
         
-        with patch('app.common.constants.user_uuid', test_user_uuid):
-            PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
-            
-            # Make request
-            response = client.post(
-                "/documents/documents/search",
-                params={
-                    "query": "What are the main topics?",
-                    "project_id": test_user_uuid
-                }
-            )
-            
-            assert response.status_code == 200
-            data = response.json()
-            assert "results" in data
-            assert len(data["results"]) == 2
-            assert data["results"][0]["filename"] == "doc1.pdf"
-    
-    def test_search_store_empty_query(self, test_user_uuid):
-        """Test search fails with empty query."""
-        response = client.post(
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        
+        # Make request
+        response = await async_client.post(
             "/documents/documents/search",
             params={
-                "query": "",
+                "query": "What are the main topics?",
                 "project_id": test_user_uuid
             }
         )
         
-        assert response.status_code == 400
-        assert "Query cannot be empty" in response.json()["detail"]
+        assert response.status_code == 200
+        data = response.json()
+        assert "results" in data
+        assert len(data["results"]) == 2
+        assert data["results"][0]["filename"] == "doc1.pdf"
+        mock_documents_service.get_store_name.assert_called_once_with(test_user_uuid)
+        mock_documents_service.search_all_user_files.assert_awaited_once_with(
+            mock_documents_service.get_store_name.return_value,
+            "What are the main topics?",
+            sample_project_files
+        )
+    
+    @pytest.mark.parametrize("params,expected_status,detail", [
+        ({"query": "", "project_id": "test-user-12345"}, 400, "Query cannot be empty"),
+        ({"query": "test query", "project_id": ""}, 400, "Project ID is required"),
+        ({"query": "test query", "project_id": "missing-project"}, 404, "No files found"),
+    ], ids=["empty_query", "empty_project_id", "no_files"])
+    async def test_search_store_error_paths(self, async_client, params, expected_status, detail):
+        """Test search rejects empty queries, empty project IDs and projects without files."""
+        response = await async_client.post("/documents/documents/search", params=params)
+        
+        assert response.status_code == expected_status
+        assert detail in response.json()["detail"]
     
-    def test_search_store_no_project_id(self):
-        """Test search fails without project ID."""
-        # The default project_id is user_uuid, so we need to test with empty string
-        response = client.post(
+    async def test_search_store_without_file_search_store(
+        self,
+        async_client,
+        mock_documents_service,
+        test_user_uuid,
+        sample_project_files
+    ):
+        """Test search returns 404 when the project has no file search store."""
+        mock_documents_service.get_store_name.return_value = None
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        
+        response = await async_client.post(
             "/documents/documents/search",
-            params={
-                "query": "test query",
-                "project_id": ""
-            }
+            params={"query": "test query", "project_id": test_user_uuid}
         )
         
-        assert response.status_code == 400
-        assert "Project ID is required" in response.json()["detail"]
-    
-    def test_search_store_no_files(self, test_user_uuid):
-        """Test search fails when no files exist for project."""
-        with patch('app.common.constants.user_uuid', test_user_uuid):
-            # Ensure PROJECT_FILE_STORE is empty for this project
-            PROJECT_FILE_STORE.pop(test_user_uuid, None)
-            
-            response = client.post(
-                "/documents/documents/search",
-                params={
-                    "query": "test query",
-                    "project_id": test_user_uuid
-                }
-            )
-            
-            assert response.status_code == 404
-            assert "No files found" in response.json()["detail"]
+        assert response.status_code == 404
+        mock_documents_service.search_all_user_files.assert_not_called()
     
-    def test_search_store_service_error(
-        self, 
+    async def test_search_store_service_error(
+        self,
+        async_client,
         mock_documents_service,
         test_user_uuid,
         sample_project_files
@@ -224,41 +271,41 @@ class TestSearchEndpoint:
             side_effect=Exception("Search service error")
         )
         
-        with patch('app.common.constants.user_uuid', test_user_uuid):
-            PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
-            
-            response = client.post(
-                "/documents/documents/search",
-                params={
-                    "query": "test query",
-                    "project_id": test_user_uuid
-                }
-            )
-            
-            assert response.status_code == 500
-            assert "Error during search" in response.json()["detail"]
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        
+        response = await async_client.post(
+            "/documents/documents/search",
+            params={
+                "query": "test query",
+                "project_id": test_user_uuid
+            }
+        )
+        
+        assert response.status_code == 500
+        assert "Error during search" in response.json()["detail"]
     
-    def test_search_store_with_default_project_id(
+    async def test_search_store_with_default_project_id(
         self,
+        async_client,
         mock_documents_service,
+        test_user_uuid,
         sample_project_files
     ):
-        """Test search uses default user_uuid when project_id not provided."""
-        from app.common.constants import user_uuid
-        
+        """Test search uses the X-User-Id user when project_id not provided."""
         search_results = [{"filename": "doc1.pdf", "snippet": "Result"}]
         mock_documents_service.search_all_user_files = AsyncMock(
             return_value=search_results
         )
         
-        PROJECT_FILE_STORE[user_uuid] = sample_project_files
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
         
-        response = client.post(
+        response = await async_client.post(
             "/documents/documents/search",
-            params={"query": "test query"}
+            params={"query": "test query"},
+            headers={"X-User-Id": test_user_uuid}
         )
         
-        # Should use default user_uuid
+        # Should use the user from the header
         assert response.status_code == 200
 
 
@@ -266,63 +313,55 @@ class TestDocumentsRouterIntegration:
     """Integration tests for complete workflows."""
     
     @pytest.fixture
-    def mock_complete_flow(self):
+    def mock_complete_flow(self, mock_documents_service):
         """Mock all external dependencies for integration test."""
-        with patch('app.router.documents_router.documents_service') as mock_service, \
-             patch('app.router.documents_router.client') as mock_client:
-            
-            # Setup DocumentsService mocks
-            mock_service.validate_documents = AsyncMock(return_value=True)
-            mock_service.upload_files_to_store = AsyncMock(return_value="test-store")
-            mock_service.search_all_user_files = AsyncMock(return_value=[
-                {"filename": "test.pdf", "snippet": "Test result"}
-            ])
-            
-            # Setup Gemini client mock
-            mock_response = MagicMock()
-            mock_response.text = "Generated brief content"
-            mock_client.models.generate_content = AsyncMock(return_value=mock_response)
-            
-            yield mock_service, mock_client
+        mock_documents_service.validate_documents = AsyncMock(return_value=True)
+        mock_documents_service.upload_files_to_store = AsyncMock(return_value="test-store")
+        mock_documents_service.generate_brief = AsyncMock(return_value="Generated brief content")
+        mock_documents_service.search_all_user_files = AsyncMock(return_value=[
+            {"filename": "test.pdf", "snippet": "Test result"}
+        ])
+        return mock_documents_service
     
-    def test_upload_and_search_workflow(
-        self, 
+    async def test_upload_and_search_workflow(
+        self,
         mock_complete_flow,
         test_user_uuid
     ):
-        """Test complete workflow: upload files, generate brief, then search."""
-        mock_service, mock_client = mock_complete_flow
+        """
+        Test complete workflow: upload files, generate brief, then search.
+        
+        Calls the endpoint functions directly; the HTTP layer is covered by
+        the endpoint test suites above.
+        """
+        mock_service = mock_complete_flow
+        
+        # Step 1: Upload files and generate brief
+        upload = UploadFile(file=io.BytesIO(b'%PDF-1.4 test content'), filename="test.pdf")
+        brief_response = await generate_brief(
+            files=[upload],
+            documents_service=mock_service
+        )
+        
+        assert brief_response.project_id == test_user_uuid
+        assert brief_response.brief == "Generated brief content"
+        mock_service.validate_documents.assert_awaited_once_with([upload])
+        
+        # Step 2: Add files to store for search
+        PROJECT_FILE_STORE[test_user_uuid] = {'test.pdf': FileRecord(
+            filename='test.pdf',
+            path=None,
+            mime_type='application/pdf',
+            size=4,
+            digest='digest-test'
+        )}
+        
+        # Step 3: Search the uploaded documents
+        search_response = await search_store(
+            query="What is in the document?",
+            documents_service=mock_service
+        )
         
-        with patch('app.common.constants.user_uuid', test_user_uuid):
-            # Step 1: Upload files and generate brief
-            with open('/tmp/workflow_test.pdf', 'wb') as f:
-                f.write(b'%PDF-1.4 test content')
-            
-            with open('/tmp/workflow_test.pdf', 'rb') as f:
-                brief_response = client.post(
-                    "/documents/documents/brief",
-                    files={"files": ("test.pdf", f, "application/pdf")}
-                )
-            
-            assert brief_response.status_code == 200
-            
-            # Step 2: Add files to store for search
-            PROJECT_FILE_STORE[test_user_uuid] = [{
-                'filename': 'test.pdf',
-                'content': b'test',
-                'mime_type': 'application/pdf'
-            }]
-            
-            # Step 3: Search the uploaded documents
-            search_response = client.post(
-                "/documents/documents/search",
-                params={
-                    "query": "What is in the document?",
-                    "project_id": test_user_uuid
-                }
-            )
-            
-            assert search_response.status_code == 200
-            results = search_response.json()["results"]
-            assert len(results) > 0
-            assert results[0]["filename"] == "test.pdf"
+        results = search_response.results
+        assert len(results) > 0
+        assert results[0].filename == "test.pdf"
@@ -6,23 +6,30 @@ Tests are organized by functionality:
 - TestFileStorage: File storage operations
 - TestFileSearch: Search and retrieval operations
 """
+import asyncio
+import io
+import math
+import os
+import random
+import threading
+import zipfile
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
 import pytest
-from unittest.mock import AsyncMock, MagicMock, patch
 from fastapi import HTTPException
+from google.genai import errors
 
-from services.documents_services import DocumentsService
-from app.common.constants import PROJECT_FILE_STORE
+from app.common import aio_file
+from app.common.constants import PROJECT_FILE_STORE, current_user_uuid
+from app.common.file_store import FileRecord
+from app.common.settings import settings
+from services import documents_services
 
 
 class TestDocumentValidation:
     """Test suite for document validation methods."""
     
-    @pytest.fixture
-    def documents_service(self, mock_gemini_client):
-        """Create DocumentsService instance for testing."""
-        return DocumentsService(mock_gemini_client.aio)
-    
-    @pytest.mark.asyncio
     async def test_validate_documents_success(
         self, 
         documents_service, 
@@ -30,13 +37,11 @@ class TestDocumentValidation:
         test_user_uuid
     ):
         """Test successful validation of valid documents."""
-        with patch('services.documents_services.user_uuid', test_user_uuid):
-            result = await documents_service.validate_documents([valid_pdf_file])
-            assert result is True
-            assert test_user_uuid in PROJECT_FILE_STORE
-            assert len(PROJECT_FILE_STORE[test_user_uuid]) == 1
+        result = await documents_service.validate_documents([valid_pdf_file])
+        assert result is True
+        assert test_user_uuid in PROJECT_FILE_STORE
+        assert len(PROJECT_FILE_STORE[test_user_uuid]) == 1
     
-    @pytest.mark.asyncio
     async def test_validate_documents_empty_list(self, documents_service):
         """Test validation fails with empty file list."""
         with pytest.raises(HTTPException) as exc_info:
@@ -45,7 +50,21 @@ class TestDocumentValidation:
         assert exc_info.value.status_code == 400
         assert "No files uploaded" in str(exc_info.value.detail)
     
-    @pytest.mark.asyncio
+    async def test_validate_documents_preflight_reads_nothing(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        invalid_extension_file,
+        test_user_uuid
+    ):
+        """Test a bad file anywhere in the list fails before any file is read."""
+        with pytest.raises(HTTPException) as exc_info:
+            await documents_service.validate_documents([valid_pdf_file, invalid_extension_file])
+        
+        assert exc_info.value.status_code == 415
+        valid_pdf_file.read.assert_not_awaited()
+        assert test_user_uuid not in PROJECT_FILE_STORE
+    
     async def test_validate_documents_no_filename(
         self, 
         documents_service,
@@ -60,7 +79,53 @@ class TestDocumentValidation:
         assert exc_info.value.status_code == 400
         assert "Invalid file name" in str(exc_info.value.detail)
     
-    @pytest.mark.asyncio
+    @pytest.mark.parametrize("filename", [
+        "../etc/passwd",
+        "../secret.pdf",
+        "dir\\report.pdf",
+        "x" * 300 + ".pdf",
+        "report.pdf\x00.exe",
+        "report\n.pdf",
+        "..",
+    ])
+    async def test_validate_documents_unsafe_filename(
+        self, 
+        documents_service,
+        create_mock_upload_file,
+        filename
+    ):
+        """Test validation rejects unsafe or overlong filenames."""
+        file = create_mock_upload_file(filename=filename)
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await documents_service.validate_documents([file])
+        
+        assert exc_info.value.status_code == 400
+        assert exc_info.value.detail == "Invalid file name"
+    
+    @pytest.mark.parametrize("filename", [
+        "good.pdf",
+        "report (1).pdf",
+        "informe final.pdf",
+        "résumé.pdf",
+        "Q1, 2024 report.pdf",
+        "a+b.pdf",
+        "O'Brien.docx",
+        "R&D.txt",
+    ])
+    async def test_validate_documents_safe_filename(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        test_user_uuid,
+        filename
+    ):
+        """Test validation accepts ordinary filenames."""
+        valid_pdf_file.filename = filename
+        
+        assert await documents_service.validate_documents([valid_pdf_file]) is True
+        assert filename in PROJECT_FILE_STORE[test_user_uuid]
+    
     async def test_validate_documents_invalid_extension(
         self, 
         documents_service,
@@ -73,7 +138,6 @@ class TestDocumentValidation:
         assert exc_info.value.status_code == 415
         assert "Unsupported file type" in str(exc_info.value.detail)
     
-    @pytest.mark.asyncio
     async def test_validate_documents_file_too_large(
         self, 
         documents_service,
@@ -86,7 +150,6 @@ class TestDocumentValidation:
         assert exc_info.value.status_code == 413
         assert "File too large" in str(exc_info.value.detail)
     
-    @pytest.mark.asyncio
     async def test_validate_documents_invalid_mime_type(
         self, 
         documents_service,
@@ -101,7 +164,53 @@ class TestDocumentValidation:
         assert ("Unsupported MIME type" in str(exc_info.value.detail) or 
                 "Unsupported file type" in str(exc_info.value.detail))
     
-    @pytest.mark.asyncio
+    async def test_validate_documents_reports_first_failing_file(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        create_mock_upload_file,
+        test_user_uuid
+    ):
+        """Test the error of the first failing file in upload order is raised."""
+        jpeg = create_mock_upload_file(filename="image.pdf", content=b"\xff\xd8\xff\xe0" + b"fake jpeg")
+        empty = create_mock_upload_file(filename="empty.txt", content=b"")
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await documents_service.validate_documents([valid_pdf_file, jpeg, empty])
+        
+        assert exc_info.value.detail == "Unsupported MIME type: image/jpeg"
+    
+    async def test_validate_documents_failure_stores_nothing(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        valid_txt_file,
+        create_mock_upload_file,
+        test_user_uuid,
+        monkeypatch
+    ):
+        """Test a failing batch stores none of its files and removes their temporary files."""
+        tmp_paths = []
+        mkstemp = documents_services.tempfile.mkstemp
+        
+        def tracking_mkstemp(*args, **kwargs):
+            fd, path = mkstemp(*args, **kwargs)
+            tmp_paths.append(path)
+            return fd, path
+        
+        monkeypatch.setattr(documents_services.tempfile, "mkstemp", tracking_mkstemp)
+        previous = FileRecord("doc.pdf", None, "application/pdf", 10, "digest")
+        PROJECT_FILE_STORE[test_user_uuid] = {"doc.pdf": previous}
+        valid_pdf_file.filename = "doc.pdf"
+        jpeg = create_mock_upload_file(filename="image.pdf", content=b"\xff\xd8\xff\xe0" + b"fake jpeg")
+        
+        with pytest.raises(HTTPException):
+            await documents_service.validate_documents([valid_pdf_file, jpeg, valid_txt_file])
+        
+        assert PROJECT_FILE_STORE[test_user_uuid] == {"doc.pdf": previous}
+        assert len(tmp_paths) == 3
+        assert not any(os.path.exists(path) for path in tmp_paths)
+    
     async def test_validate_documents_multiple_files(
         self, 
         documents_service,
@@ -110,25 +219,36 @@ class TestDocumentValidation:
         test_user_uuid
     ):
         """Test validation of multiple valid files."""
-        with patch('services.documents_services.user_uuid', test_user_uuid):
-            result = await documents_service.validate_documents([valid_pdf_file, valid_txt_file])
-            assert result is True
-            assert len(PROJECT_FILE_STORE[test_user_uuid]) == 2
-    
-    def test_validate_extension_valid(self, documents_service):
-        """Test _validate_extension with valid extensions."""
-        assert documents_service._validate_extension("document.pdf") is True
-        assert documents_service._validate_extension("file.txt") is True
-        assert documents_service._validate_extension("doc.docx") is True
-        assert documents_service._validate_extension("readme.md") is True
-        assert documents_service._validate_extension("FILE.PDF") is True  # Case insensitive
-    
-    def test_validate_extension_invalid(self, documents_service):
-        """Test _validate_extension with invalid extensions."""
-        assert documents_service._validate_extension("malware.exe") is False
-        assert documents_service._validate_extension("image.jpg") is False
-        assert documents_service._validate_extension("archive.zip") is False
-        assert documents_service._validate_extension("script.js") is False
+        result = await documents_service.validate_documents([valid_pdf_file, valid_txt_file])
+        assert result is True
+        assert len(PROJECT_FILE_STORE[test_user_uuid]) == 2
+    
+    @pytest.mark.parametrize("filename,expected", [
+        ("document.pdf", True),
+        ("file.txt", True),
+        ("doc.docx", True),
+        ("readme.md", True),
+        ("FILE.PDF", True),  # Case insensitive
+        ("malware.exe", False),
+        ("image.jpg", False),
+        ("archive.zip", False),
+        ("script.js", False),
+        ("pdf", False),  # No extension
+    ])
+    def test_validate_extension(self, documents_service, filename, expected):
+        """Test _validate_extension against allowed and disallowed extensions."""
+        assert documents_service._validate_extension(filename) is expected
+    
+    def test_validate_extension_is_cached(self, documents_service):
+        """Test repeated filenames are answered from the extension cache."""
+        cache_info = documents_services._is_allowed_extension.cache_info
+        documents_service._validate_extension("report.pdf")
+        hits = cache_info().hits
+        
+        documents_service._validate_extension("report.pdf")
+        documents_service._validate_extension("report.pdf")
+        
+        assert cache_info().hits == hits + 2
     
     def test_validate_size_valid(self, documents_service, valid_pdf_file):
         """Test _validate_size with file within limit."""
@@ -138,28 +258,124 @@ class TestDocumentValidation:
         """Test _validate_size with file exceeding limit."""
         assert documents_service._validate_size(oversized_file) is False
     
-    @pytest.mark.asyncio
+    async def test_validate_documents_unknown_size_too_large(
+        self, 
+        documents_service,
+        create_mock_upload_file,
+        test_user_uuid
+    ):
+        """Test a file without a declared size is rejected as soon as it is read past the limit."""
+        file = create_mock_upload_file(
+            filename="large.pdf", content=b"%PDF-1.4\n" + bytes(settings.max_file_size + aio_file.BLOCK_SIZE)
+        )
+        file.size = None
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await documents_service.validate_documents([file])
+        
+        assert exc_info.value.status_code == 413
+        assert test_user_uuid not in PROJECT_FILE_STORE
+        # Reading stops at the first chunk past the limit, leaving the tail unread
+        assert file.read.await_count == math.ceil(settings.max_file_size / aio_file.BLOCK_SIZE) + 1
+    
+    async def test_validate_documents_mime_mismatch(
+        self, 
+        documents_service,
+        create_mock_upload_file,
+        test_user_uuid
+    ):
+        """Test a file whose contents do not match an allowed MIME type is rejected."""
+        file = create_mock_upload_file(filename="image.pdf", content=b"\xff\xd8\xff\xe0" + b"fake jpeg")
+        
+        with pytest.raises(HTTPException) as exc_info:
+            await documents_service.validate_documents([file])
+        
+        assert exc_info.value.status_code == 415
+        assert "Unsupported MIME type" in str(exc_info.value.detail)
+        assert test_user_uuid not in PROJECT_FILE_STORE
+    
+    async def test_validate_documents_reads_once(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        test_user_uuid
+    ):
+        """Test validation reads each file once, without seeking back."""
+        await documents_service.validate_documents([valid_pdf_file])
+        
+        # One chunk holding the whole file, then end of file
+        assert valid_pdf_file.read.await_count == 2
+        valid_pdf_file.seek.assert_not_awaited()
+    
     async def test_get_mime_type_pdf(self, documents_service, valid_pdf_file):
         """Test MIME type detection for PDF files."""
-        mime_type = await documents_service._get_mime_type(valid_pdf_file)
+        mime_type = await documents_service._get_mime_type(valid_pdf_file.file.getvalue())
         assert mime_type == "application/pdf"
     
-    @pytest.mark.asyncio
     async def test_get_mime_type_text(self, documents_service, valid_txt_file):
         """Test MIME type detection for text files."""
-        mime_type = await documents_service._get_mime_type(valid_txt_file)
+        mime_type = await documents_service._get_mime_type(valid_txt_file.file.getvalue())
         assert mime_type == "text/plain"
+    
+    async def test_get_mime_type_reads_only_header(self, documents_service, monkeypatch):
+        """Test MIME type detection only looks at the file header."""
+        from_buffer = MagicMock(wraps=documents_services._MIME.from_buffer)
+        monkeypatch.setattr(documents_services._MIME, 'from_buffer', from_buffer)
+        
+        mime_type = await documents_service._get_mime_type(b"%PDF-1.4\n" + bytes(64 * 1024))
+        
+        assert mime_type == "application/pdf"
+        from_buffer.assert_called_once()
+        assert len(from_buffer.call_args.args[0]) == documents_services.MIME_SNIFF_SIZE
+    
+    async def test_get_mime_type_runs_off_event_loop(self, documents_service, monkeypatch):
+        """Test libmagic runs in a worker thread, not on the event loop thread."""
+        sniff_threads = []
+        from_buffer = documents_services._MIME.from_buffer
+        
+        def record_thread(buffer):
+            sniff_threads.append(threading.get_ident())
+            return from_buffer(buffer)
+        
+        monkeypatch.setattr(documents_services._MIME, 'from_buffer', record_thread)
+        
+        mime_type = await documents_service._get_mime_type(b"%PDF-1.4\n")
+        
+        assert mime_type == "application/pdf"
+        assert sniff_threads and threading.get_ident() not in sniff_threads
+    
+    async def test_mime_alias_accepted(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        test_user_uuid,
+        monkeypatch
+    ):
+        """Test a PDF reported under an alias is accepted and stored as application/pdf."""
+        monkeypatch.setattr(documents_services._MIME, 'from_buffer', lambda buffer: "application/x-pdf")
+        
+        await documents_service.validate_documents([valid_pdf_file])
+        
+        stored_file = PROJECT_FILE_STORE[test_user_uuid][valid_pdf_file.filename]
+        assert stored_file.mime_type == "application/pdf"
+    
+    async def test_get_mime_type_docx(self, documents_service):
+        """Test docx files are recognised when their document entries lie past the header."""
+        rng = random.Random(0)
+        docx = io.BytesIO()
+        with zipfile.ZipFile(docx, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('[Content_Types].xml', rng.randbytes(400).hex())
+            archive.writestr('_rels/.rels', rng.randbytes(300).hex())
+            archive.writestr('word/document.xml', rng.randbytes(3000).hex())
+        
+        mime_type = await documents_service._get_mime_type(docx.getvalue())
+        
+        assert mime_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
 
 
 class TestFileStorage:
     """Test suite for file storage operations."""
     
-    @pytest.fixture
-    def documents_service(self, mock_gemini_client):
-        """Create DocumentsService instance for testing."""
-        return DocumentsService(mock_gemini_client.aio)
-    
-    @pytest.mark.asyncio
     async def test_store_project_files_new_user(
         self, 
         documents_service,
@@ -167,18 +383,96 @@ class TestFileStorage:
         test_user_uuid
     ):
         """Test storing files for a new user."""
-        with patch('services.documents_services.user_uuid', test_user_uuid):
-            await documents_service.store_project_files(valid_pdf_file, "application/pdf")
-            
-            assert test_user_uuid in PROJECT_FILE_STORE
-            assert len(PROJECT_FILE_STORE[test_user_uuid]) == 1
-            
-            stored_file = PROJECT_FILE_STORE[test_user_uuid][0]
-            assert stored_file['filename'] == valid_pdf_file.filename
-            assert stored_file['mime_type'] == "application/pdf"
-            assert 'content' in stored_file
-    
-    @pytest.mark.asyncio
+        filename = valid_pdf_file.filename
+        await documents_service.store_project_files(valid_pdf_file)
+        
+        assert test_user_uuid in PROJECT_FILE_STORE
+        assert len(PROJECT_FILE_STORE[test_user_uuid]) == 1
+        
+        stored_file = PROJECT_FILE_STORE[test_user_uuid][filename]
+        assert stored_file.filename == filename
+        assert stored_file.mime_type == "application/pdf"
+        assert stored_file.size == valid_pdf_file.size
+        with open(stored_file.path, 'rb') as f:
+            assert f.read() == valid_pdf_file.file.getvalue()
+    
+    async def test_store_evicts_least_recent_user(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        test_user_uuid
+    ):
+        """Test the least recently active user is evicted past capacity, with their temp files."""
+        await documents_service.store_project_files(valid_pdf_file)
+        path = PROJECT_FILE_STORE[test_user_uuid][valid_pdf_file.filename].path
+        
+        for index in range(PROJECT_FILE_STORE.maxsize):
+            PROJECT_FILE_STORE[f"other-user-{index}"] = {}
+        await asyncio.gather(*PROJECT_FILE_STORE._pending_removals)
+        
+        assert test_user_uuid not in PROJECT_FILE_STORE
+        assert len(PROJECT_FILE_STORE) == PROJECT_FILE_STORE.maxsize
+        assert not os.path.exists(path)
+    
+    async def test_store_eviction_drops_user_state(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_file_search_store,
+        test_user_uuid
+    ):
+        """Test evicting a user drops the service state kept for them and deletes their store."""
+        stores = documents_service.client.file_search_stores
+        stores.create = AsyncMock(return_value=mock_file_search_store)
+        stores.delete = AsyncMock()
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        store_name = await documents_service.upload_files_to_store()
+        
+        for index in range(PROJECT_FILE_STORE.maxsize):
+            PROJECT_FILE_STORE[f"other-user-{index}"] = {}
+        await asyncio.gather(*documents_service._pending_deletions)
+        
+        assert documents_service.get_store_name(test_user_uuid) is None
+        assert store_name not in documents_service._uploaded_files
+        stores.delete.assert_awaited_once_with(name=store_name, config={'force': True})
+    
+    async def test_store_keeps_users_in_use(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        test_user_uuid
+    ):
+        """Test a user whose files are in use is kept, and the next least recent user evicted."""
+        await documents_service.store_project_files(valid_pdf_file)
+        path = PROJECT_FILE_STORE[test_user_uuid][valid_pdf_file.filename].path
+        
+        with PROJECT_FILE_STORE.in_use(test_user_uuid):
+            for index in range(PROJECT_FILE_STORE.maxsize):
+                PROJECT_FILE_STORE[f"other-user-{index}"] = {}
+        
+        assert test_user_uuid in PROJECT_FILE_STORE
+        assert "other-user-0" not in PROJECT_FILE_STORE
+        assert len(PROJECT_FILE_STORE) == PROJECT_FILE_STORE.maxsize
+        assert os.path.exists(path)
+    
+    async def test_store_defers_removal_when_all_users_in_use(
+        self, 
+        documents_service,
+        valid_pdf_file,
+        test_user_uuid
+    ):
+        """Test files of a user evicted while in use are removed once the user is done."""
+        await documents_service.store_project_files(valid_pdf_file)
+        path = PROJECT_FILE_STORE[test_user_uuid][valid_pdf_file.filename].path
+        
+        with PROJECT_FILE_STORE.in_use(test_user_uuid):
+            evicted_user_uuid, _ = PROJECT_FILE_STORE.popitem()
+            assert evicted_user_uuid == test_user_uuid
+            assert os.path.exists(path)
+        await asyncio.gather(*PROJECT_FILE_STORE._pending_removals)
+        
+        assert not os.path.exists(path)
+    
     async def test_store_project_files_existing_user(
         self, 
         documents_service,
@@ -187,13 +481,29 @@ class TestFileStorage:
         test_user_uuid
     ):
         """Test storing multiple files for existing user."""
-        with patch('services.documents_services.user_uuid', test_user_uuid):
-            await documents_service.store_project_files(valid_pdf_file, "application/pdf")
-            await documents_service.store_project_files(valid_txt_file, "text/plain")
-            
-            assert len(PROJECT_FILE_STORE[test_user_uuid]) == 2
+        await documents_service.store_project_files(valid_pdf_file)
+        await documents_service.store_project_files(valid_txt_file)
+        
+        assert len(PROJECT_FILE_STORE[test_user_uuid]) == 2
+    
+    async def test_store_project_files_replaces_same_filename(
+        self, 
+        documents_service,
+        create_mock_upload_file,
+        test_user_uuid
+    ):
+        """Test storing a file again under the same name replaces the first copy."""
+        first = create_mock_upload_file(filename="notes.txt", content=b"first version")
+        second = create_mock_upload_file(filename="notes.txt", content=b"second version")
+        
+        await documents_service.store_project_files(first)
+        first_path = PROJECT_FILE_STORE[test_user_uuid]["notes.txt"].path
+        await documents_service.store_project_files(second)
+        
+        assert len(PROJECT_FILE_STORE[test_user_uuid]) == 1
+        assert PROJECT_FILE_STORE[test_user_uuid]["notes.txt"].size == len(b"second version")
+        assert not os.path.exists(first_path)
     
-    @pytest.mark.asyncio
     async def test_ensure_store_exists_creates_new(
         self, 
         documents_service,
@@ -205,29 +515,93 @@ class TestFileStorage:
             return_value=mock_file_search_store
         )
         
-        with patch('app.common.constants.user_uuid', test_user_uuid):
-            store_name = await documents_service.ensure_store_exists()
-            
-            assert store_name == mock_file_search_store.name
-            assert documents_service.file_search_store_name == mock_file_search_store.name
-            documents_service.client.file_search_stores.create.assert_called_once()
+        store_name = await documents_service.ensure_store_exists()
+        
+        assert store_name == mock_file_search_store.name
+        assert documents_service.get_store_name(test_user_uuid) == mock_file_search_store.name
+        documents_service.client.file_search_stores.create.assert_called_once()
     
-    @pytest.mark.asyncio
     async def test_ensure_store_exists_reuses_existing(
         self, 
         documents_service,
-        mock_file_search_store
+        mock_file_search_store,
+        test_user_uuid
     ):
-        """Test ensure_store_exists reuses existing store."""
-        documents_service.file_search_store_name = mock_file_search_store.name
-        documents_service.client.file_search_stores.create = AsyncMock()
+        """Test ensure_store_exists reuses the user's existing store."""
+        documents_service.client.file_search_stores.create = AsyncMock(
+            return_value=mock_file_search_store
+        )
         
+        first_store_name = await documents_service.ensure_store_exists()
         store_name = await documents_service.ensure_store_exists()
         
-        assert store_name == mock_file_search_store.name
-        documents_service.client.file_search_stores.create.assert_not_called()
+        assert store_name == first_store_name == mock_file_search_store.name
+        documents_service.client.file_search_stores.create.assert_called_once()
+    
+    async def test_ensure_store_exists_concurrent_calls_keep_one_store(
+        self, 
+        documents_service,
+        test_user_uuid
+    ):
+        """Test concurrent first calls for a user keep one store and delete the extra one."""
+        created = iter(["stores/first", "stores/second"])
+        
+        async def create(config):
+            name = next(created)
+            await asyncio.sleep(0)
+            return SimpleNamespace(name=name)
+        
+        stores = documents_service.client.file_search_stores
+        stores.create = AsyncMock(side_effect=create)
+        stores.delete = AsyncMock()
+        
+        store_names = await asyncio.gather(
+            documents_service.ensure_store_exists(), documents_service.ensure_store_exists()
+        )
+        
+        assert store_names == ["stores/first", "stores/first"]
+        stores.delete.assert_awaited_once_with(name="stores/second", config={'force': True})
+    
+    async def test_stores_are_separate_per_user(
+        self, 
+        documents_service,
+        create_mock_upload_file
+    ):
+        """Test each user uploads to and searches their own store, even for identical files."""
+        stores = documents_service.client.file_search_stores
+        stores.create = AsyncMock(
+            side_effect=lambda config: SimpleNamespace(name=f"stores/{config['display_name']}")
+        )
+        stores.upload_to_file_search_store = AsyncMock(
+            return_value=SimpleNamespace(name="upload-operation")
+        )
+        documents_service.client.models.generate_content = AsyncMock(
+            return_value=SimpleNamespace(text="[]")
+        )
+        
+        store_names = {}
+        for user_uuid in ("alice", "bob"):
+            token = current_user_uuid.set(user_uuid)
+            try:
+                file = create_mock_upload_file(filename=f"{user_uuid}.txt", content=b"same contents")
+                await documents_service.validate_documents([file])
+                store_names[user_uuid] = await documents_service.upload_files_to_store()
+            finally:
+                current_user_uuid.reset(token)
+        
+        assert store_names == {"alice": "stores/project_store_alice", "bob": "stores/project_store_bob"}
+        uploads = {
+            call.kwargs['config']['display_name']: call.kwargs['file_search_store_name']
+            for call in stores.upload_to_file_search_store.call_args_list
+        }
+        assert uploads == {"alice.txt": store_names["alice"], "bob.txt": store_names["bob"]}
+        
+        await documents_service.search_all_user_files(
+            documents_service.get_store_name("bob"), "query", PROJECT_FILE_STORE["bob"]
+        )
+        config = documents_service.client.models.generate_content.call_args.kwargs['config']
+        assert config.tools[0].file_search.file_search_store_names == [store_names["bob"]]
     
-    @pytest.mark.asyncio
     async def test_upload_files_to_store_success(
         self, 
         documents_service,
@@ -243,16 +617,214 @@ class TestFileStorage:
         documents_service.client.file_search_stores.upload_to_file_search_store = AsyncMock()
         
         # Populate PROJECT_FILE_STORE
-        with patch('services.documents_services.user_uuid', test_user_uuid):
-            PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
-            
-            store_name = await documents_service.upload_files_to_store()
-            
-            assert store_name == mock_file_search_store.name
-            # Verify upload was called for each file
-            assert documents_service.client.file_search_stores.upload_to_file_search_store.call_count == 2
-    
-    @pytest.mark.asyncio
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        
+        store_name = await documents_service.upload_files_to_store()
+        
+        assert store_name == mock_file_search_store.name
+        # Verify upload was called for each file
+        assert documents_service.client.file_search_stores.upload_to_file_search_store.call_count == 2
+        # Local copies are released once uploaded
+        assert all(record.path is None for record in PROJECT_FILE_STORE[test_user_uuid].values())
+    
+    async def test_upload_files_to_store_concurrent(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_file_search_store,
+        test_user_uuid
+    ):
+        """Test files are uploaded concurrently rather than one after another."""
+        in_flight = 0
+        max_in_flight = 0
+        
+        async def slow_upload(**kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return SimpleNamespace(name=f"operations/{kwargs['config']['display_name']}")
+        
+        documents_service.client.file_search_stores.create = AsyncMock(
+            return_value=mock_file_search_store
+        )
+        documents_service.client.file_search_stores.upload_to_file_search_store = AsyncMock(
+            side_effect=slow_upload
+        )
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        
+        await documents_service.upload_files_to_store()
+        
+        assert documents_service.client.file_search_stores.upload_to_file_search_store.call_count == 2
+        assert max_in_flight == 2
+    
+    async def test_upload_files_to_store_bounded_concurrency(
+        self, 
+        documents_service,
+        mock_file_search_store,
+        test_user_uuid,
+        tmp_path
+    ):
+        """Test no more uploads than the upload concurrency run at once."""
+        in_flight = 0
+        max_in_flight = 0
+        
+        async def tracked_upload(**kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return SimpleNamespace(name=f"operations/{kwargs['config']['display_name']}")
+        
+        documents_service._upload_semaphore = asyncio.Semaphore(2)
+        documents_service.client.file_search_stores.create = AsyncMock(
+            return_value=mock_file_search_store
+        )
+        documents_service.client.file_search_stores.upload_to_file_search_store = AsyncMock(
+            side_effect=tracked_upload
+        )
+        project_files = {}
+        for i in range(6):
+            path = tmp_path / f"doc{i}.txt"
+            path.write_bytes(b"content %d" % i)
+            project_files[path.name] = FileRecord(path.name, str(path), "text/plain", 9, f"digest-{i}")
+        PROJECT_FILE_STORE[test_user_uuid] = project_files
+        
+        await documents_service.upload_files_to_store()
+        
+        assert documents_service.client.file_search_stores.upload_to_file_search_store.call_count == 6
+        assert max_in_flight == 2
+    
+    async def test_upload_files_to_store_skips_uploaded_files(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_file_search_store,
+        test_user_uuid
+    ):
+        """Test files already uploaded are not uploaded again."""
+        documents_service.client.file_search_stores.create = AsyncMock(
+            return_value=mock_file_search_store
+        )
+        documents_service.client.file_search_stores.upload_to_file_search_store = AsyncMock()
+        
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        
+        await documents_service.upload_files_to_store()
+        await documents_service.upload_files_to_store()
+        
+        assert documents_service.client.file_search_stores.upload_to_file_search_store.call_count == 2
+    
+    async def test_upload_files_to_store_skips_reuploaded_files(
+        self, 
+        documents_service,
+        valid_txt_file,
+        mock_file_search_store,
+        test_user_uuid
+    ):
+        """Test a file stored again with the same name and contents is not uploaded again."""
+        documents_service.client.file_search_stores.create = AsyncMock(
+            return_value=mock_file_search_store
+        )
+        documents_service.client.file_search_stores.upload_to_file_search_store = AsyncMock()
+        
+        await documents_service.validate_documents([valid_txt_file])
+        await documents_service.upload_files_to_store()
+        await valid_txt_file.seek(0)
+        await documents_service.validate_documents([valid_txt_file])
+        path = PROJECT_FILE_STORE[test_user_uuid][valid_txt_file.filename].path
+        await documents_service.upload_files_to_store()
+        
+        documents_service.client.file_search_stores.upload_to_file_search_store.assert_called_once()
+        assert PROJECT_FILE_STORE[test_user_uuid][valid_txt_file.filename].path is None
+        assert not os.path.exists(path)
+    
+    async def test_upload_files_to_store_concurrent_requests_share_uploads(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_file_search_store,
+        test_user_uuid
+    ):
+        """Test concurrent uploads for the same user upload each file once, before it is released."""
+        async def upload(file_search_store_name, file, config):
+            assert os.path.exists(file)
+            await asyncio.sleep(0.01)
+            return SimpleNamespace(name=f"operations/{config['display_name']}")
+        
+        stores = documents_service.client.file_search_stores
+        stores.create = AsyncMock(return_value=mock_file_search_store)
+        stores.upload_to_file_search_store = AsyncMock(side_effect=upload)
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        await documents_service.ensure_store_exists()
+        
+        await asyncio.gather(
+            documents_service.upload_files_to_store(), documents_service.upload_files_to_store()
+        )
+        
+        assert stores.upload_to_file_search_store.call_count == 2
+        assert all(record.path is None for record in PROJECT_FILE_STORE[test_user_uuid].values())
+        assert not documents_service._pending_uploads
+    
+    async def test_upload_files_to_store_uploads_renamed_copies(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_file_search_store,
+        test_user_uuid
+    ):
+        """Test a copy of a file under another name is uploaded under that name."""
+        stores = documents_service.client.file_search_stores
+        stores.create = AsyncMock(return_value=mock_file_search_store)
+        stores.upload_to_file_search_store = AsyncMock()
+        copy_path = sample_project_files['doc1.pdf'].path + '.copy'
+        with open(copy_path, 'wb') as f:
+            f.write(b'PDF content here')
+        sample_project_files['copy.pdf'] = sample_project_files['doc1.pdf']._replace(
+            filename='copy.pdf', path=copy_path
+        )
+        
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        
+        await documents_service.upload_files_to_store()
+        
+        display_names = sorted(
+            call.kwargs['config']['display_name']
+            for call in stores.upload_to_file_search_store.call_args_list
+        )
+        assert display_names == ['copy.pdf', 'doc1.pdf', 'doc2.txt']
+        assert PROJECT_FILE_STORE[test_user_uuid]['copy.pdf'].path is None
+    
+    async def test_upload_files_to_store_retries_transient_errors(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_file_search_store,
+        test_user_uuid,
+        create_api_error,
+        retry_sleep
+    ):
+        """Test a failed upload is retried without failing the other uploads."""
+        documents_service.client.file_search_stores.create = AsyncMock(
+            return_value=mock_file_search_store
+        )
+        documents_service.client.file_search_stores.upload_to_file_search_store = AsyncMock(
+            side_effect=[
+                create_api_error(503),
+                SimpleNamespace(name='operations/doc1'),
+                SimpleNamespace(name='operations/doc2'),
+            ]
+        )
+        
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        
+        await documents_service.upload_files_to_store()
+        
+        assert documents_service.client.file_search_stores.upload_to_file_search_store.call_count == 3
+        assert all(record.path is None for record in PROJECT_FILE_STORE[test_user_uuid].values())
+    
     async def test_upload_files_to_store_empty(
         self, 
         documents_service,
@@ -265,90 +837,292 @@ class TestFileStorage:
         )
         documents_service.client.file_search_stores.upload_to_file_search_store = AsyncMock()
         
-        with patch('app.common.constants.user_uuid', test_user_uuid):
-            PROJECT_FILE_STORE[test_user_uuid] = []
-            
-            store_name = await documents_service.upload_files_to_store()
-            
-            assert store_name == mock_file_search_store.name
-            documents_service.client.file_search_stores.upload_to_file_search_store.assert_not_called()
+        PROJECT_FILE_STORE[test_user_uuid] = {}
+        
+        store_name = await documents_service.upload_files_to_store()
+        
+        assert store_name == mock_file_search_store.name
+        documents_service.client.file_search_stores.upload_to_file_search_store.assert_not_called()
 
 
 class TestFileSearch:
     """Test suite for file search operations."""
     
     @pytest.fixture
-    def documents_service(self, mock_gemini_client):
-        """Create DocumentsService instance for testing."""
-        service = DocumentsService(mock_gemini_client.aio)
-        service.file_search_store_name = "test-store-name"
-        return service
+    def mock_search_response(self):
+        """Mock Gemini search response with one snippet per file."""
+        return SimpleNamespace(text=(
+            '```json\n'
+            '[{"filename": "doc1.pdf", "snippet": "Result 1"},'
+            ' {"filename": "doc2.txt", "snippet": "Result 2"},'
+            ' {"filename": "unknown.pdf", "snippet": "Not a project file"}]\n'
+            '```'
+        ))
+    
+    async def test_search_all_user_files_success(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_search_response
+    ):
+        """Test searching all user files with a single Gemini request."""
+        documents_service.client.models.generate_content = AsyncMock(
+            return_value=mock_search_response
+        )
+        
+        query = "What are the key points?"
+        results = await documents_service.search_all_user_files("test-store-name", query, sample_project_files)
+        
+        assert results == [
+            {"filename": "doc1.pdf", "snippet": "Result 1"},
+            {"filename": "doc2.txt", "snippet": "Result 2"},
+        ]
+        documents_service.client.models.generate_content.assert_called_once()
+        prompt = documents_service.client.models.generate_content.call_args.kwargs['contents']
+        assert query in prompt and "doc1.pdf" in prompt and "doc2.txt" in prompt
     
-    @pytest.mark.asyncio
-    async def test_search_individual_file_success(
+    async def test_search_all_user_files_single_round_trip(
         self, 
         documents_service,
         mock_generate_content_response
     ):
-        """Test searching an individual file."""
+        """Test searching many files costs one Gemini round trip, not one per file."""
         documents_service.client.models.generate_content = AsyncMock(
             return_value=mock_generate_content_response
         )
+        project_files = {
+            f"doc{i}.txt": FileRecord(f"doc{i}.txt", None, "text/plain", 1, f"digest-{i}")
+            for i in range(10)
+        }
+        
+        results = await documents_service.search_all_user_files("test-store-name", "query", project_files)
+        
+        assert len(results) == 10
+        documents_service.client.models.generate_content.assert_called_once()
+    
+    async def test_search_all_user_files_unparseable_response(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_generate_content_response
+    ):
+        """Test a non-JSON answer is returned as the snippet of every file."""
+        documents_service.client.models.generate_content = AsyncMock(
+            return_value=mock_generate_content_response
+        )
+        
+        query = "What are the key points?"
+        results = await documents_service.search_all_user_files("test-store-name", query, sample_project_files)
+        
+        assert [result['filename'] for result in results] == ['doc1.pdf', 'doc2.txt']
+        assert all(result['snippet'] == mock_generate_content_response.text for result in results)
+    
+    async def test_search_all_user_files_no_text(
+        self, 
+        documents_service,
+        sample_project_files
+    ):
+        """Test a reply without text gives every file an empty snippet."""
+        documents_service.client.models.generate_content = AsyncMock(
+            return_value=SimpleNamespace(text=None)
+        )
+        
+        results = await documents_service.search_all_user_files("test-store-name", "query", sample_project_files)
+        
+        assert results == [
+            {"filename": "doc1.pdf", "snippet": ""},
+            {"filename": "doc2.txt", "snippet": ""},
+        ]
+    
+    async def test_search_all_user_files_uses_cache(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_search_response
+    ):
+        """Test repeating a search is served from the response cache."""
+        documents_service.client.models.generate_content = AsyncMock(
+            return_value=mock_search_response
+        )
         
-        file_info = {'filename': 'test.pdf'}
         query = "What is the main topic?"
         
-        result = await documents_service.search_individual_file(query, file_info)
+        first = await documents_service.search_all_user_files("test-store-name", query, sample_project_files)
+        second = await documents_service.search_all_user_files("test-store-name", query, sample_project_files)
         
-        assert result['filename'] == 'test.pdf'
-        assert result['snippet'] == mock_generate_content_response.text
+        assert first == second
         documents_service.client.models.generate_content.assert_called_once()
     
-    @pytest.mark.asyncio
-    async def test_search_all_user_files_success(
+    async def test_generate_brief_success(
         self, 
         documents_service,
         sample_project_files,
         mock_generate_content_response
     ):
-        """Test searching all user files."""
+        """Test generating a brief of the project files."""
         documents_service.client.models.generate_content = AsyncMock(
             return_value=mock_generate_content_response
         )
         
-        query = "What are the key points?"
-        results = await documents_service.search_all_user_files(query, sample_project_files)
+        brief = await documents_service.generate_brief("test-store-name", sample_project_files)
         
-        assert len(results) == 2
-        assert all('filename' in result for result in results)
-        assert all('snippet' in result for result in results)
-        assert documents_service.client.models.generate_content.call_count == 2
+        assert brief == mock_generate_content_response.text
+        prompt = documents_service.client.models.generate_content.call_args.kwargs['contents']
+        assert "doc1.pdf" in prompt and "doc2.txt" in prompt
+    
+    async def test_generate_brief_no_text(
+        self, 
+        documents_service,
+        sample_project_files
+    ):
+        """Test a reply without text, e.g. a blocked one, gives an empty brief."""
+        documents_service.client.models.generate_content = AsyncMock(
+            return_value=SimpleNamespace(text=None)
+        )
+        
+        brief = await documents_service.generate_brief("test-store-name", sample_project_files)
+        
+        assert brief == ""
+    
+    async def test_generate_brief_uses_cache(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_generate_content_response
+    ):
+        """Test a brief for the same files is served from the response cache."""
+        documents_service.client.models.generate_content = AsyncMock(
+            return_value=mock_generate_content_response
+        )
+        
+        await documents_service.generate_brief("test-store-name", sample_project_files)
+        await documents_service.generate_brief("test-store-name", dict(reversed(sample_project_files.items())))
+        
+        documents_service.client.models.generate_content.assert_called_once()
+    
+    async def test_upload_keeps_response_cache(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_generate_content_response,
+        test_user_uuid
+    ):
+        """Test an upload leaves cached responses, whose keys already cover store and contents, in place."""
+        documents_service.client.models.generate_content = AsyncMock(
+            return_value=mock_generate_content_response
+        )
+        documents_service.client.file_search_stores.upload_to_file_search_store = AsyncMock()
+        
+        await documents_service.generate_brief("other-store-name", {})
+        PROJECT_FILE_STORE[test_user_uuid] = sample_project_files
+        await documents_service.upload_files_to_store()
+        await documents_service.generate_brief("other-store-name", {})
+        
+        documents_service.client.models.generate_content.assert_called_once()
+    
+    @pytest.mark.parametrize("text", [None, ""])
+    async def test_empty_responses_are_not_cached(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_generate_content_response,
+        text
+    ):
+        """Test an empty reply is not cached, so the next request asks Gemini again."""
+        documents_service.client.models.generate_content = AsyncMock(
+            side_effect=[SimpleNamespace(text=text), mock_generate_content_response] * 2
+        )
+        
+        await documents_service.generate_brief("test-store-name", sample_project_files)
+        brief = await documents_service.generate_brief("test-store-name", sample_project_files)
+        await documents_service.search_all_user_files("test-store-name", "query", sample_project_files)
+        results = await documents_service.search_all_user_files("test-store-name", "query", sample_project_files)
+        
+        assert brief == mock_generate_content_response.text
+        assert results[0]['snippet'] == mock_generate_content_response.text
+        assert documents_service.client.models.generate_content.call_count == 4
     
-    @pytest.mark.asyncio
     async def test_search_all_user_files_empty_list(
         self, 
         documents_service
     ):
         """Test searching with empty file list."""
         query = "What are the key points?"
-        results = await documents_service.search_all_user_files(query, [])
+        results = await documents_service.search_all_user_files("test-store-name", query, {})
         
         assert results == []
     
-    @pytest.mark.asyncio
-    async def test_search_individual_file_api_error(
+    async def test_search_all_user_files_api_error(
         self, 
-        documents_service
+        documents_service,
+        sample_project_files,
+        retry_sleep
     ):
-        """Test search handles API errors gracefully."""
+        """Test search propagates non-API errors to the caller without retrying."""
         documents_service.client.models.generate_content = AsyncMock(
-            side_effect=Exception("API Error")
+            side_effect=ValueError("API Error")
         )
         
-        file_info = {'filename': 'test.pdf'}
         query = "What is the main topic?"
         
-        with pytest.raises(Exception) as exc_info:
-            await documents_service.search_individual_file(query, file_info)
+        with pytest.raises(ValueError) as exc_info:
+            await documents_service.search_all_user_files("test-store-name", query, sample_project_files)
         
         assert "API Error" in str(exc_info.value)
+        documents_service.client.models.generate_content.assert_called_once()
+        retry_sleep.assert_not_awaited()
+    
+    async def test_search_all_user_files_retries_transient_errors(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_search_response,
+        create_api_error,
+        retry_sleep
+    ):
+        """Test rate limits and server errors are retried with exponential backoff."""
+        documents_service.client.models.generate_content = AsyncMock(
+            side_effect=[create_api_error(429), create_api_error(503), mock_search_response]
+        )
+        
+        results = await documents_service.search_all_user_files("test-store-name", "query", sample_project_files)
+        
+        assert len(results) == 2
+        assert documents_service.client.models.generate_content.call_count == 3
+        assert [call.args[0] for call in retry_sleep.await_args_list] == [0.25, 0.5]
+    
+    async def test_generate_brief_honors_retry_after(
+        self, 
+        documents_service,
+        sample_project_files,
+        mock_generate_content_response,
+        create_api_error,
+        retry_sleep
+    ):
+        """Test the Retry-After header of a rate-limited response sets the wait."""
+        documents_service.client.models.generate_content = AsyncMock(
+            side_effect=[create_api_error(429, {'retry-after': '2'}), mock_generate_content_response]
+        )
+        
+        brief = await documents_service.generate_brief("test-store-name", sample_project_files)
+        
+        assert brief == mock_generate_content_response.text
+        retry_sleep.assert_awaited_once_with(2.0)
+    
+    async def test_generate_brief_does_not_retry_client_errors(
+        self, 
+        documents_service,
+        sample_project_files,
+        create_api_error,
+        retry_sleep
+    ):
+        """Test client errors other than rate limits fail without retrying."""
+        documents_service.client.models.generate_content = AsyncMock(
+            side_effect=create_api_error(400)
+        )
+        
+        with pytest.raises(errors.ClientError):
+            await documents_service.generate_brief("test-store-name", sample_project_files)
+        
+        documents_service.client.models.generate_content.assert_called_once()
+        retry_sleep.assert_not_awaited()